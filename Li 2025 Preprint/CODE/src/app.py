@@ -1,16 +1,13 @@
+import argparse
+import importlib
 import pickle as pkl
 import sys
+import threading
 import time
 from pathlib import Path
 
-import h5py
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import tifffile as tiff
-from matplotlib import colors
-from matplotlib.path import Path as PltPath
-from PyQt5.QtCore import QRegExp, Qt
+from PyQt5.QtCore import QRegExp, Qt, QTimer
 from PyQt5.QtGui import QDoubleValidator, QIntValidator, QRegExpValidator
 from PyQt5.QtWidgets import (
     QAction,
@@ -30,11 +27,36 @@ from PyQt5.QtWidgets import (
     QPushButton,
     QWidget,
 )
-from scipy import ndimage, stats
 
 # Global variable for pyqtgraph - set in main()
 pg = None
 
+# Modules needed only for loading, saving and analysis.  They are imported where
+# they are used and warmed up in the background once the window is shown.
+DEFERRED_MODULES = (
+    "tifffile",
+    "h5py",
+    "matplotlib.pyplot",
+    "session",
+    "masks",
+    "histograms",
+)
+
+
+def warm_up(modules=DEFERRED_MODULES):
+    """Import the deferred modules in a background thread."""
+
+    def run():
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
 
 class InputDialogIntensity(QWidget):
     """Dialog for collecting user inputs for intensity analysis."""
@@ -129,8 +151,8 @@ class UI(QMainWindow):
         # ROI storage
         self.masks_dict = {}  # key: exclusion name, value: ROI outline
         self.masks_label_dict = {}
-        self.hole = None
-        self.hole_label = None
+        self.holes_dict = {}  # key: "Hole <k>", k is the hole id in the mask file
+        self.holes_label_dict = {}
 
         # Temporary ROI drawing storage (cleared after each mask is saved)
         self.mask_counter = 1
@@ -143,6 +165,13 @@ class UI(QMainWindow):
         self._image_view_initialized = False
 
         self.windows = []
+        self.density_panel = None
+
+        # Annotation session (see session.py)
+        self.image_set = None
+        self.session = None
+        self.session_index = None
+        self.modified = False
 
         # GUI components
         self.id_label = QLabel("No Images")
@@ -150,7 +179,7 @@ class UI(QMainWindow):
         self.channel_box = QComboBox()
         self.channel_box.currentIndexChanged.connect(self.changeChannel)
 
-        self.create_hole_button = QPushButton("Set Implant Hole")
+        self.create_hole_button = QPushButton("Add Implant Hole")
         self.create_hole_button.clicked.connect(self.drawHole)
         self.create_hole_button.setEnabled(False)
 
@@ -200,6 +229,24 @@ class UI(QMainWindow):
         self.open_action.setShortcut("Ctrl+O")
         self.open_action.triggered.connect(self.safelyOpenNewSet)
 
+        self.session_action = QAction("Open &Session Folder", self)
+        self.session_action.setShortcut("Ctrl+Shift+O")
+        self.session_action.triggered.connect(self.openSession)
+
+        self.next_action = QAction("&Next Set", self)
+        self.next_action.setShortcut("Ctrl+Right")
+        self.next_action.triggered.connect(self.nextSet)
+        self.next_action.setEnabled(False)
+
+        self.previous_action = QAction("&Previous Set", self)
+        self.previous_action.setShortcut("Ctrl+Left")
+        self.previous_action.triggered.connect(self.previousSet)
+        self.previous_action.setEnabled(False)
+
+        self.prefetch_previous_action = QAction("Keep Previous Set Loaded", self)
+        self.prefetch_previous_action.setCheckable(True)
+        self.prefetch_previous_action.toggled.connect(self.togglePrefetchPrevious)
+
         self.close_action = QAction("&Close Application", self)
         self.close_action.setShortcut("Ctrl+W")
         self.close_action.triggered.connect(self.quitApp)
@@ -213,6 +260,9 @@ class UI(QMainWindow):
         self.int_analysis.triggered.connect(self.askInput)
         self.int_analysis.setEnabled(True)
 
+        self.live_density = QAction("Live Density Panel", self)
+        self.live_density.triggered.connect(self.showDensityPanel)
+
         self.cp_compile = QAction("Compile Cellpose Result")
         self.cp_compile.setEnabled(False)
 
@@ -220,6 +270,11 @@ class UI(QMainWindow):
         menuBar = self.menuBar()
         file_menu = menuBar.addMenu("&File")
         file_menu.addAction(self.open_action)
+        file_menu.addAction(self.session_action)
+        file_menu.addAction(self.next_action)
+        file_menu.addAction(self.previous_action)
+        file_menu.addAction(self.prefetch_previous_action)
+        file_menu.addSeparator()
         file_menu.addAction(self.close_action)
 
         edit_menu = menuBar.addMenu("&Edit")
@@ -227,6 +282,7 @@ class UI(QMainWindow):
 
         analysis_menu = menuBar.addMenu("&Analysis")
         analysis_menu.addAction(self.int_analysis)
+        analysis_menu.addAction(self.live_density)
         analysis_menu.addAction(self.cp_compile)
 
     def _initializeImageView(self):
@@ -266,14 +322,13 @@ class UI(QMainWindow):
 
         self.masks_dict = {}
 
-        if (
-            self.hole is not None
-            and self._image_view_initialized
-            and self.imv is not None
-        ):
-            self.imv.removeItem(self.hole)
-            self.imv.removeItem(self.hole_label)
-            self.hole = None
+        if self._image_view_initialized and self.imv is not None:
+            for key, roi in self.holes_dict.items():
+                self.imv.removeItem(roi)
+                self.imv.removeItem(self.holes_label_dict[key])
+
+        self.holes_dict = {}
+        self.holes_label_dict = {}
 
         self.mask_ls.clear()
 
@@ -282,7 +337,6 @@ class UI(QMainWindow):
                 self.imv.removeItem(label)
 
         self.masks_label_dict = {}
-        self.hole_label = None
 
     def safelyOpenNewSet(self):
         """Safely open new image set with user confirmation if data exists."""
@@ -299,57 +353,157 @@ class UI(QMainWindow):
         """Load a new set of TIFF images into the application."""
         fname = QFileDialog.getOpenFileNames(self, "", "", "TIFF Files (*.tif)")
         if fname[0]:
-            self.clearUp()
+            self.loadImageSet(fname[0])
 
-            id_ls = []
-            id = None
+    def loadImageSet(self, paths, load_config=True):
+        """Load the given TIFF channels of one image set and any saved configuration."""
+        from session import ImageSet
 
-            for f in sorted(fname[0], key=str.lower):
-                self.image_path_list.append(Path(f))
-                id_ls.append(Path(f).parent.name)
-                self.display_level_list.append(None)
-
-            if len(set(id_ls)) == 1:
-                id = list(set(id_ls))[0]
-            else:
-                print("Error: Image IDs do not match.")
+        if paths:
+            self.closeSession()
 
-            progress = QProgressDialog(
-                "Loading Images...", "", 0, len(self.image_path_list)
-            )
+            progress = QProgressDialog("Loading Images...", "", 0, len(paths))
             progress.setCancelButton(None)
             progress.setWindowTitle("Progress")
             progress.setMinimumDuration(0)
             progress.setValue(0)
             progress.show()
 
-            # Extract channel names by finding common filename parts
-            temp_split = []
-            for p in self.image_path_list:
-                temp_split.append(p.stem.split("_"))
-
-            common_parts = set(temp_split[0]).intersection(*temp_split)
-
-            for i, path in enumerate(self.image_path_list, start=1):
-                ch_name = [x for x in path.stem.split("_") if x not in common_parts]
-                self.channel_list.append("_".join(ch_name))
-                self.image_data_list.append(np.array(tiff.imread(path)).T)
+            def advance(i):
                 progress.setValue(i)
                 QApplication.processEvents()
 
-            self.channel_box.addItems(self.channel_list)
-            self.id_label.setText(id)
+            image_set = ImageSet.load(paths, load_config=load_config, callback=advance)
+            self.showImageSet(image_set)
 
-            if not self._image_view_initialized:
-                self._initializeImageView()
-            if self.imv is not None:
-                self.imv.setImage(self.image_data_list[0])
+    def showImageSet(self, image_set, notify=True):
+        """Display a loaded image set and restore its saved ROIs."""
+        self.clearUp()
+        self.image_set = image_set
+        self.image_path_list = list(image_set.paths)
+        self.image_data_list = list(image_set.images)
+        self.channel_list = list(image_set.channels)
+        self.display_level_list = [None] * len(self.image_data_list)
 
-            # Load existing configuration if available
-            for config in self.image_path_list[0].parent.rglob("*.pickle"):
-                self.loadConfig(config)
+        self.channel_box.addItems(self.channel_list)
+        self.id_label.setText(self.sessionLabel(image_set.image_id))
 
-            self.buttonsEnabled(True)
+        if not self._image_view_initialized:
+            self._initializeImageView()
+        if self.imv is not None:
+            self.imv.setImage(self.image_data_list[0])
+
+        # Load existing configuration if available
+        if image_set.configs:
+            message = "Masks are loaded from an existing configuration."
+            if notify:
+                msg = QMessageBox()
+                msg.setIcon(QMessageBox.Information)
+                msg.setText(message)
+                msg.setStandardButtons(QMessageBox.Ok)
+                msg.exec_()
+            else:
+                self.statusBar().showMessage(message, 5000)
+        for master_dict in image_set.configs:
+            self.applyConfig(master_dict)
+
+        if self.density_panel is not None:
+            self.density_panel.setImageSet(self)
+
+        self.buttonsEnabled(True)
+        self.modified = False
+
+    def sessionLabel(self, image_id):
+        """Image id, followed by the position in the session if one is open."""
+        if self.session is None or image_id is None:
+            return image_id
+        return f"{image_id} ({self.session_index + 1}/{len(self.session)})"
+
+    def openSession(self):
+        """Annotate the image-id folders of a group one after another."""
+        from session import Prefetcher, find_image_sets
+
+        if self.modified:
+            response = self.alert(
+                "Unsaved changes will be lost.  Do you want to open a session?"
+            )
+            if response != QMessageBox.Yes:
+                return
+
+        folder = QFileDialog.getExistingDirectory(
+            self, "Open the group folder containing the image-id folders"
+        )
+        if not folder:
+            return
+
+        folders = find_image_sets(folder)
+        if not folders:
+            self._showError("No image sets were found in this folder.")
+            return
+
+        self.closeSession()
+        self.session = Prefetcher(
+            folders, previous=self.prefetch_previous_action.isChecked()
+        )
+        self.goToSet(0)
+
+    def goToSet(self, index):
+        """Show the session's image set at ``index`` and prefetch its neighbours."""
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            image_set = self.session.get(index)
+        except Exception as err:
+            QApplication.restoreOverrideCursor()
+            name = self.session.folders[index].name
+            self._showError(f"{name} could not be loaded: {err}")
+            return
+        QApplication.restoreOverrideCursor()
+
+        self.session_index = index
+        self.showImageSet(image_set, notify=False)
+        self.session.prefetch(index)
+
+        self.next_action.setEnabled(index + 1 < len(self.session))
+        self.previous_action.setEnabled(index > 0)
+
+    def stepSet(self, step):
+        """Move ``step`` sets through the session after an unsaved-change check."""
+        if self.session is None:
+            return
+        index = self.session_index + step
+        if not 0 <= index < len(self.session):
+            return
+        if self.modified:
+            response = self.alert(
+                "Unsaved changes will be lost.  Do you want to switch sets?"
+            )
+            if response != QMessageBox.Yes:
+                return
+        self.goToSet(index)
+
+    def nextSet(self):
+        self.stepSet(1)
+
+    def previousSet(self):
+        self.stepSet(-1)
+
+    def togglePrefetchPrevious(self, checked):
+        """Also keep the previous set of the session in memory."""
+        if self.session is not None:
+            self.session.previous = checked
+            self.session.prefetch(self.session_index)
+
+    def closeSession(self):
+        """Leave session mode and free the prefetched sets."""
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+        self.session_index = None
+        self.next_action.setEnabled(False)
+        self.previous_action.setEnabled(False)
+
+    def setModified(self, *args):
+        self.modified = True
 
     def buttonsEnabled(self, enabled):
         """Enable or disable all buttons to prevent errors during operations."""
@@ -389,27 +543,12 @@ class UI(QMainWindow):
             )
 
     def drawHole(self):
-        """Start drawing an implant hole (red outline)."""
+        """Start drawing an implant hole (red outline); an image may have several."""
         color = "r"
-
-        if self.hole is not None:
-            response = self.alert("A hole already exists.  Do you want to replace it?")
-            if response == QMessageBox.Yes:
-                self.imv.removeItem(self.hole)
-                self.imv.removeItem(self.hole_label)
-                self.hole = None
-                self.hole_label = None
-                self.mask_ls.takeItem(0)
-
-                self.imv.scene.sigMouseClicked.connect(
-                    lambda event: self.polyLine(event, color)
-                )
-                self.buttonsEnabled(False)
-        else:
-            self.imv.scene.sigMouseClicked.connect(
-                lambda event: self.polyLine(event, color)
-            )
-            self.buttonsEnabled(False)
+        self.imv.scene.sigMouseClicked.connect(
+            lambda event: self.polyLine(event, color)
+        )
+        self.buttonsEnabled(False)
 
     def drawMask(self):
         """Start drawing an exclusion mask (yellow outline)."""
@@ -419,6 +558,12 @@ class UI(QMainWindow):
         )
         self.buttonsEnabled(False)
 
+    def roiDicts(self, key):
+        """ROI and label dictionaries holding the hole or exclusion ``key``."""
+        if key.startswith("Hole"):
+            return self.holes_dict, self.holes_label_dict
+        return self.masks_dict, self.masks_label_dict
+
     def annotateMask(self, text, key):
         """Add a text label to a drawn mask at its center point."""
         label = pg.TextItem(
@@ -426,12 +571,9 @@ class UI(QMainWindow):
         )
         label.setZValue(10)
 
-        if key is None:  # Hole
-            points = self.hole.getState()["points"]
-            self.hole_label = label
-        else:  # Exclusion mask
-            points = self.masks_dict[key].getState()["points"]
-            self.masks_label_dict[key] = label
+        rois, labels = self.roiDicts(key)
+        points = rois[key].getState()["points"]
+        labels[key] = label
 
         center = np.mean(points, axis=0)
         label.setPos(center[0], center[1])
@@ -440,10 +582,39 @@ class UI(QMainWindow):
     def updateLabel(self, roi, key):
         """Update label position when user drags ROI handles."""
         new_pos = np.mean(roi.getState()["points"], axis=0)
-        if key is None:
-            self.hole_label.setPos(new_pos[0], new_pos[1])
+        self.roiDicts(key)[1][key].setPos(new_pos[0], new_pos[1])
+
+    def connectRoi(self, roi, key):
+        """Keep the label and the live density panel in sync with ROI edits."""
+        roi.sigRegionChangeFinished.connect(lambda roi: self.updateLabel(roi, key))
+        roi.sigRegionChangeFinished.connect(self.setModified)
+        if key.startswith("Hole"):
+            roi.sigRegionChangeFinished.connect(self.densityHoleChanged)
         else:
-            self.masks_label_dict[key].setPos(new_pos[0], new_pos[1])
+            roi.sigRegionChangeFinished.connect(
+                lambda _: self.densityExclusionChanged(key)
+            )
+
+    def showDensityPanel(self):
+        """Open the live per-bin density panel for the current image set."""
+        from live_density import DensityPanel
+
+        if self.density_panel is None:
+            self.density_panel = DensityPanel()
+            self.windows.append(self.density_panel)
+            self.density_panel.setImageSet(self)
+        self.density_panel.show()
+        self.density_panel.raise_()
+
+    def densityHoleChanged(self, *args):
+        """Forward hole edits to the live density panel."""
+        if self.density_panel is not None:
+            self.density_panel.holeChanged()
+
+    def densityExclusionChanged(self, key):
+        """Forward exclusion edits to the live density panel."""
+        if self.density_panel is not None:
+            self.density_panel.exclusionChanged(key)
 
     def saveMask(self):
         """Save the currently drawn exclusion mask."""
@@ -451,33 +622,50 @@ class UI(QMainWindow):
         self.masks_dict[mask_key] = self.temp_roi
 
         self.annotateMask(str(self.mask_counter), mask_key)
-        self.masks_dict[mask_key].sigRegionChangeFinished.connect(
-            lambda roi: self.updateLabel(roi, mask_key)
-        )
+        self.connectRoi(self.masks_dict[mask_key], mask_key)
 
         self.mask_counter += 1
         self.mask_ls.addItem(mask_key)
         self.finishDrawing()
+        self.modified = True
+        self.densityExclusionChanged(mask_key)
 
     def saveHole(self):
         """Save the currently drawn hole."""
-        self.hole = self.temp_roi
-        self.annotateMask("H", None)
-        self.hole.sigRegionChangeFinished.connect(
-            lambda roi: self.updateLabel(roi, None)
-        )
-        self.mask_ls.insertItem(0, "Hole")
+        self.addHole(self.temp_roi)
         self.finishDrawing()
+        self.modified = True
+        self.densityHoleChanged()
+
+    def addHole(self, roi):
+        """Register a shown hole outline as the next hole (``Hole <k>``, label Hk)."""
+        n = len(self.holes_dict) + 1
+        key = f"Hole {n}"
+        self.holes_dict[key] = roi
+        self.annotateMask(f"H{n}", key)
+        self.connectRoi(roi, key)
+        self.mask_ls.insertItem(n - 1, key)
+
+    def renumberHoles(self):
+        """Number the remaining holes 1, 2, ... again, as they are saved."""
+        rois = list(self.holes_dict.values())
+        for key, label in self.holes_label_dict.items():
+            self.imv.removeItem(label)
+            self.mask_ls.takeItem(
+                self.mask_ls.row(self.mask_ls.findItems(key, Qt.MatchExactly)[0])
+            )
+        self.holes_dict = {}
+        self.holes_label_dict = {}
+        for roi in rois:
+            roi.sigRegionChangeFinished.disconnect()
+            self.addHole(roi)
 
     def viewMask(self):
         """Zoom to the selected ROI in the image view."""
         for item in self.mask_ls.selectedItems():
             mask_key = item.text()
 
-            if mask_key == "Hole":
-                rect = self.hole.parentBounds()
-            else:
-                rect = self.masks_dict[mask_key].parentBounds()
+            rect = self.roiDicts(mask_key)[0][mask_key].parentBounds()
 
             # Add padding around the ROI
             padding = min(rect.height(), rect.width()) * 2
@@ -494,21 +682,27 @@ class UI(QMainWindow):
             "The selected item will be deleted permanently.  Are you sure?"
         )
         if response == QMessageBox.Yes:
+            self.modified = True
+            holes_deleted = False
             for item in self.mask_ls.selectedItems():
                 mask_key = item.text()
 
-                if mask_key == "Hole":
-                    self.imv.removeItem(self.hole)
-                    self.imv.removeItem(self.hole_label)
-                    self.mask_ls.takeItem(0)
-                    self.hole = None
-                    self.hole_label = None
+                if mask_key.startswith("Hole"):
+                    self.imv.removeItem(self.holes_dict.pop(mask_key))
+                    self.imv.removeItem(self.holes_label_dict.pop(mask_key))
+                    self.mask_ls.takeItem(self.mask_ls.row(item))
+                    holes_deleted = True
                 else:
                     self.imv.removeItem(self.masks_dict[mask_key])
                     self.imv.removeItem(self.masks_label_dict[mask_key])
                     self.masks_dict.pop(mask_key, None)
                     self.masks_label_dict.pop(mask_key, None)
                     self.mask_ls.takeItem(self.mask_ls.row(item))
+                    self.densityExclusionChanged(mask_key)
+
+            if holes_deleted:
+                self.renumberHoles()
+                self.densityHoleChanged()
 
     def polyLine(self, event, color):
         """Handle polygon drawing with mouse clicks. Left click adds points, right click finishes."""
@@ -552,7 +746,7 @@ class UI(QMainWindow):
 
     def saveConfig(self):
         """Save configuration file containing holes and exclusion masks."""
-        num_hole = 1 if self.hole is not None else 0
+        num_hole = len(self.holes_dict)
         num_masks = len(self.masks_dict)
 
         if num_hole == 0:
@@ -564,7 +758,7 @@ class UI(QMainWindow):
             return
 
         confirm_msg = (
-            f"Number of Hole: {num_hole}\n"
+            f"Number of Holes: {num_hole}\n"
             f"Number of Exclusions: {num_masks}\n\n"
             "Are you sure you want to save?"
         )
@@ -590,8 +784,11 @@ class UI(QMainWindow):
         pkl_fname = f"{image_id}_config.pickle"
         pkl_path = self.image_path_list[0].parent / pkl_fname
 
+        holes_states = [roi.saveState() for roi in self.holes_dict.values()]
         master_dict = {
-            "hole": self.hole.saveState() if self.hole is not None else None,
+            # first hole kept under "hole" for readers of single-hole configs
+            "hole": holes_states[0] if holes_states else None,
+            "holes_states": holes_states,
             "exclusions_states": [
                 item.saveState() for item in self.masks_dict.values()
             ],
@@ -600,8 +797,19 @@ class UI(QMainWindow):
         with open(pkl_path, "wb") as f:
             pkl.dump(master_dict, f)
 
+        # keep a prefetched copy of this set in sync with what was saved
+        if self.image_set is not None:
+            self.image_set.configs = [master_dict]
+        self.modified = False
+
     def saveH5Mask(self, num_hole, num_masks):
         """Save masks as binary maps in HDF5 format."""
+        import h5py
+        import matplotlib.pyplot as plt
+        from matplotlib import colors
+
+        from masks import label_holes, rasterize, write_mask_datasets
+
         progress = QProgressDialog("Saving Changes...", "", 0, num_hole + num_masks)
         progress.setCancelButton(None)
         progress.setWindowTitle("Progress")
@@ -622,35 +830,21 @@ class UI(QMainWindow):
         hf = h5py.File(h5_path, "w")
 
         nx, ny = self.image_data_list[0].shape[:2]
-        x, y = np.meshgrid(np.arange(nx), np.arange(ny))
-        x, y = x.flatten(), y.flatten()
-        points = np.vstack((x, y)).T  # Coordinates for path containment check
-
-        if self.hole is not None:
-            coord_hole = self.hole.saveState()["points"]
-            path = PltPath(coord_hole)
-            grid = path.contains_points(points).reshape((ny, nx))
-            hf.create_dataset("hole", data=grid, compression="gzip")
-        else:
-            hf.create_dataset("hole", data=np.full((ny, nx), False), compression="gzip")
 
-        progress.setValue(1)
+        hole_labels = label_holes(
+            [roi.saveState()["points"] for roi in self.holes_dict.values()], (ny, nx)
+        )
+        progress.setValue(num_hole)
 
-        if self.masks_dict:
-            grid = np.full((ny, nx), False)
-            for mask in self.masks_dict.values():
-                path = PltPath(mask.saveState()["points"])
-                temp_grid = path.contains_points(points).reshape((ny, nx))
-                grid = np.logical_or(grid, temp_grid)
+        grid = np.full((ny, nx), False)
+        for mask in self.masks_dict.values():
+            temp_grid = rasterize(mask.saveState()["points"], (ny, nx))
+            grid = np.logical_or(grid, temp_grid)
 
-                progress.setValue(progress.value() + 1)
-                QApplication.processEvents()
+            progress.setValue(progress.value() + 1)
+            QApplication.processEvents()
 
-            hf.create_dataset("exclusions", data=grid, compression="gzip")
-        else:
-            hf.create_dataset(
-                "exclusions", data=np.full((ny, nx), False), compression="gzip"
-            )
+        write_mask_datasets(hf, hole_labels, grid)
 
         # Create preview plot
         plt.imshow(hf["hole"][:], cmap=cmap_hole)
@@ -660,28 +854,19 @@ class UI(QMainWindow):
 
         hf.close()
 
-    def loadConfig(self, path):
-        """Load previous configuration from pickle file."""
-        msg = QMessageBox()
-        msg.setIcon(QMessageBox.Information)
-        msg.setText("Masks are loaded from an existing configuration.")
-        msg.setStandardButtons(QMessageBox.Ok)
-        msg.exec_()
-
-        with open(path, "rb") as config:
-            master_dict = pkl.load(config)
+    def applyConfig(self, master_dict):
+        """Restore the holes and exclusions of a saved configuration."""
+        from masks import hole_states
 
-        h_state = master_dict["hole"]
-        if h_state is not None:
-            self.hole = pg.PolyLineROI(
+        for h_state in hole_states(master_dict):
+            roi = pg.PolyLineROI(
                 h_state["points"],
                 movable=False,
                 pen=pg.mkPen(cosmetic=True, width=4, color="r"),
                 closed=True,
             )
-            self.imv.addItem(self.hole)
-            self.annotateMask("H", None)
-            self.mask_ls.insertItem(0, "Hole")
+            self.imv.addItem(roi)
+            self.addHole(roi)
 
         mask_states = master_dict["exclusions_states"]
         if mask_states:
@@ -695,6 +880,7 @@ class UI(QMainWindow):
                 )
                 self.imv.addItem(self.masks_dict[key])
                 self.annotateMask(str(self.mask_counter), key)
+                self.connectRoi(self.masks_dict[key], key)
                 self.mask_ls.addItem(key)
                 self.mask_counter += 1
 
@@ -756,6 +942,17 @@ class UI(QMainWindow):
 
     def intensityAnalysis(self, params):
         """Perform intensity analysis on images using user-specified parameters."""
+        import matplotlib.pyplot as plt
+
+        from histograms import (
+            HIST_SUFFIX,
+            find_intensity_inputs,
+            image_histogram,
+            intensity_tables,
+            unpack_h5,
+            write_tables,
+        )
+
         folder_path = QFileDialog.getExistingDirectory(
             self, "Open the folder containing all images"
         )
@@ -766,22 +963,6 @@ class UI(QMainWindow):
 
         data_path = Path(folder_path)
 
-        def match_id(identifier, file_ext, search_path):
-            """Find file matching identifier and extension. Returns last match if multiple found."""
-            matches = list(Path(search_path).rglob(f"*{identifier}*{file_ext}"))
-            return matches[-1] if matches else None
-
-        def unpack_h5(file_path):
-            """Extract hole and combined mask data from HDF5 file."""
-            with h5py.File(file_path, "r") as f:
-                return f["hole"][:], np.logical_or(f["hole"][:], f["exclusions"][:])
-
-        # Initialize data lists
-        image_ids = []
-        mask_paths = []
-        tiff_paths = []
-        valid_ids = []
-
         # Parse user parameters
         upper_limit_um = int(params["up_lim"])
         step_size = int(params["step"])
@@ -792,26 +973,8 @@ class UI(QMainWindow):
 
         bins = np.arange(0, upper_limit_um + step_size, step_size)
 
-        # Find all mask files and corresponding images
-        for mask_path in data_path.rglob("*_mask.h5"):
-            mask_paths.append(mask_path)
-            image_id = mask_path.parent.name
-            image_ids.append(image_id)
-
-            # Find corresponding TIFF files for each channel
-            channel_paths = []
-            for channel in channels:
-                channel_paths.append(match_id(channel, ".tif", mask_path.parent))
-
-            # Only include if all channels are found
-            if None in channel_paths:
-                tiff_paths.append(None)
-            else:
-                tiff_paths.append(channel_paths)
-
-        # Create batch array and filter out incomplete data
-        batch = np.array([image_ids, mask_paths, tiff_paths], dtype=object).T
-        batch = batch[~np.any(batch is None, axis=1)]
+        # Find all mask files with images for every channel
+        batch = find_intensity_inputs(data_path, channels)
 
         if len(batch) == 0:
             self._showError("No images/masks were found. Please start over.")
@@ -835,7 +998,7 @@ class UI(QMainWindow):
         msg.exec_()
 
         # Initialize results storage
-        results_master = [[] for _ in range(len(channels))]
+        hists = []
         valid_ids = []
 
         progress = QProgressDialog("Analyzing intensity...", "", 0, len(batch))
@@ -859,23 +1022,14 @@ class UI(QMainWindow):
 
             valid_ids.append(image_id)
 
-            # Calculate distance from hole for each pixel
-            dist_2d_pixels = ndimage.distance_transform_edt(map_hole - 1)
-            dist_1d_um = (
-                np.ma.array(dist_2d_pixels, mask=mask_all).compressed()
-            ) * conv_factor
-
-            intensity_results = []
-
-            # Measure intensity for each channel
-            for path in channel_files:
-                img = tiff.imread(path)
-                intensity_1d = np.ma.array(img, mask=mask_all).compressed()
-
-                bin_means, _, _ = stats.binned_statistic(
-                    dist_1d_um, intensity_1d, statistic="mean", bins=bins
-                )
-                intensity_results.append(bin_means)
+            # Accumulate fine-step histograms so bins can be changed later
+            hist = image_histogram(
+                map_hole, mask_all, channels, channel_files, step_size, conv_factor
+            )
+            hist.save(
+                mask_file.parent / f"{image_id}{HIST_SUFFIX}", conv_fct=conv_factor
+            )
+            hists.append(hist)
 
             # Create and save intensity plot
             fig, axes = plt.subplots(nrows=len(channels), figsize=(10, 6))
@@ -883,7 +1037,8 @@ class UI(QMainWindow):
             axes_arr = np.array(axes)
 
             for i, ax in enumerate(axes_arr.flatten()):
-                ax.plot(bins[1:], intensity_results[i], label=channels[i])
+                step_means, _, _ = hist.rebin(channels[i], step_size, upper_limit_um)
+                ax.plot(bins[1:], step_means, label=channels[i])
                 ax.legend(fontsize="large")
                 ax.set_ylabel("Intensity")
                 ax.set_xlabel("Distance (micron)")
@@ -892,35 +1047,16 @@ class UI(QMainWindow):
             plt.savefig(mask_file.parent / f"{image_id}_intensity-plot.png", dpi=200)
             plt.close()
 
-            # Compile results for each channel
-            for i, channel_data in enumerate(intensity_results):
-                reshaped = np.sum(
-                    np.reshape(
-                        channel_data,
-                        (upper_limit_um // bin_width_um, bin_width_um // step_size),
-                    ),
-                    axis=1,
-                )
-                # Normalize intensities
-                normalized = reshaped / reshaped[-1] - (1 - norm_methods[i])
-                results_master[i].append(np.clip(normalized, 0, None))
-
             progress.setValue(counter)
             QApplication.processEvents()
             counter += 1
 
         # Export results to Excel
-        dist_range = np.arange(0, upper_limit_um, bin_width_um)
-        headers = [f"{x}-{x + bin_width_um}" for x in dist_range]
-
+        tables = intensity_tables(
+            hists, valid_ids, channels, norm_methods, bin_width_um, upper_limit_um
+        )
         output_filename = f"{time.strftime('%Y%m%d-%H%M%S')}_intensity-raw-output.xlsx"
-        with pd.ExcelWriter(data_path / output_filename) as writer:
-            for i, channel in enumerate(channels):
-                df = pd.DataFrame(
-                    data=results_master[i], index=valid_ids, columns=headers
-                )
-                df.index.name = "id"
-                df.to_excel(writer, sheet_name=channel)
+        write_tables(tables, data_path / output_filename)
 
         self.int_analysis.setEnabled(True)
 
@@ -955,11 +1091,26 @@ class UI(QMainWindow):
         return msg.exec_()
 
 
+def report(marker, start):
+    """Print a startup benchmark marker (seconds since ``start``)."""
+    print(f"{marker} {time.perf_counter() - start:.4f}", flush=True)
+
+
 def main():
     """Main function to run the Image Wizard application."""
     global pg
 
-    app = QApplication(sys.argv)
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser(description="Image Wizard")
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="print startup markers, load the given images and exit",
+    )
+    parser.add_argument("images", nargs="*", help="TIFF channels of one image set")
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
 
     # Import pyqtgraph after QApplication creation to avoid widget creation errors
     import pyqtgraph as pyqt_graph
@@ -969,6 +1120,20 @@ def main():
     window = UI()
     window._initializeImageView()
     window.show()
+    warm_up()
+
+    if args.benchmark:
+        app.processEvents()
+        report("first_window", start)
+        if args.images:
+            window.loadImageSet(args.images, load_config=False)
+            app.processEvents()
+            report("first_image", start)
+        QTimer.singleShot(0, app.quit)
+        sys.exit(app.exec_())
+
+    if args.images:
+        QTimer.singleShot(0, lambda: window.loadImageSet(args.images))
     sys.exit(app.exec_())
 
 
@@ -0,0 +1,79 @@
+"""Startup-time benchmark for the Image Wizard GUI.
+
+Launches the GUI in a fresh process several times with ``--benchmark`` and
+reports the time from process start to the first shown window and to the first
+displayed image.  Works for ``app.py`` and for the packaged executable.
+"""
+
+import argparse
+import csv
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+APP = Path(__file__).with_name("app.py")
+MARKERS = ("first_window", "first_image")
+
+
+def run_once(command, images):
+    """Seconds from launch until each marker is printed by the GUI."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [*command, "--benchmark", *map(str, images)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    times = {}
+    for line in proc.stdout:
+        fields = line.split()
+        if fields and fields[0] in MARKERS:
+            times[fields[0]] = time.perf_counter() - start
+    proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"GUI exited with code {proc.returncode}")
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="*", help="TIFF channels of one image set")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--exe", help="packaged executable to time instead of src/app.py"
+    )
+    parser.add_argument("--output", help="append the medians to this CSV file")
+    args = parser.parse_args()
+
+    command = [args.exe] if args.exe else [sys.executable, str(APP)]
+    runs = [run_once(command, args.images) for _ in range(args.runs)]
+
+    medians = {}
+    for marker in MARKERS:
+        values = [run[marker] for run in runs if marker in run]
+        if values:
+            medians[marker] = statistics.median(values)
+            print(
+                f"{marker}: median {medians[marker]:.3f} s, "
+                f"min {min(values):.3f} s over {len(values)} runs"
+            )
+
+    if args.output:
+        path = Path(args.output)
+        new_file = not path.exists()
+        with open(path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["date", "command", *MARKERS])
+            writer.writerow(
+                [
+                    time.strftime("%Y-%m-%d %H:%M:%S"),
+                    " ".join(command),
+                    *(f"{medians.get(m, float('nan')):.4f}" for m in MARKERS),
+                ]
+            )
+
+
+if __name__ == "__main__":
+    main()
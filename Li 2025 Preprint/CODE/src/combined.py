@@ -0,0 +1,120 @@
+"""Neuron density and stain intensity of one image in a single pass.
+
+The SECOND mask is read once and one distance transform is turned into one
+map of fine distance-step indices.  Density bins are whole groups of steps, so
+the density/count/area tables and the intensity histogram are both folded from
+the same map and always use the same distances.
+
+With several holes, the same distance transform also returns the nearest hole
+of every pixel, so density, count and area are split per hole without a
+transform per hole.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import tifffile as tiff
+
+from distance import load_centroids, read_h5_mask, read_hole_labels, save_preview
+from histograms import IntensityHistogram, fold, fold_shape, match_id
+from masks import distance_map, nearest_hole
+from objects import mask_factors
+
+
+def step_map(hole_mask, conv_fct, step):
+    """Fine-step index (distance from the hole in units of ``step`` um) per pixel."""
+    return (distance_map(hole_mask) * conv_fct // step).astype(np.intp)
+
+
+def binned_by_hole(steps, nearest, n_holes, n_steps, factor, n_bins):
+    """Bin counts of fine-step indices: row 0 for all holes, row ``k`` for hole k.
+
+    ``nearest`` is the hole id of each entry, or ``None`` for a single row.
+    """
+    flat = steps if nearest is None else nearest.astype(np.intp) * n_steps + steps
+    table = np.bincount(flat, minlength=(n_holes + 1) * n_steps)
+    table = table.reshape(n_holes + 1, n_steps)
+    table[0] += table[1:].sum(axis=0)
+    return np.array([fold(row, factor, n_bins) for row in table])
+
+
+def analyze_image(
+    mask_path,
+    second_img_dir,
+    bins,
+    conv_fct,
+    comp_fct,
+    channels=(),
+    step=5,
+    preview_path=None,
+    by_hole=False,
+):
+    """Density (per mm^2), count and area (mm^2) per bin and the intensity histogram.
+
+    Matches the raster mode of ``distance.analyze_image`` for the density and
+    ``histograms.image_histogram`` for the intensity.  The bin width must be a
+    multiple of ``step``; without ``channels`` the histogram is ``None``.  With
+    ``by_hole`` neurons and area are attributed to their nearest hole and
+    density, count and area have one row per hole after the row for all holes.
+    Factors recorded in the mask take precedence (see ``objects.mask_factors``).
+    """
+    conv_fct, mask_scale = mask_factors(mask_path, conv_fct, comp_fct)
+    second_img_dir = Path(second_img_dir)
+    second_mask_path = next(second_img_dir.glob("*_mask.h5"))
+    hole_mask, exclusion_mask = read_h5_mask(second_mask_path)
+    excluded = hole_mask if exclusion_mask is None else hole_mask | exclusion_mask
+
+    factor, n_bins = fold_shape(step, bins[1] - bins[0], bins[-1])
+    if by_hole:
+        hole_labels = read_hole_labels(second_mask_path)
+        dist, nearest = nearest_hole(hole_labels)
+        steps = (dist * conv_fct // step).astype(np.intp)
+        n_holes = int(hole_labels.max())
+    else:
+        steps = step_map(hole_mask, conv_fct, step)
+        nearest, n_holes = None, 0
+    n_steps = int(steps.max()) + 1
+
+    def binned(index):
+        return binned_by_hole(
+            steps[index],
+            None if nearest is None else nearest[index],
+            n_holes,
+            n_steps,
+            factor,
+            n_bins,
+        )
+
+    # density: neurons outside the hole/exclusions, area of everything but the hole
+    cp_centroids = load_centroids(mask_path, excluded, comp_fct=mask_scale)
+    y_centroids = cp_centroids[:, 1].astype(int)
+    x_centroids = cp_centroids[:, 0].astype(int)
+    count = binned((y_centroids, x_centroids))
+    area = binned(~hole_mask) * comp_fct**2
+    if not by_hole:
+        count, area = count[0], area[0]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        density = count / area * 1e6  # convert to mm^2
+    area = area / 1e6  # convert to mm^2
+
+    # intensity: pixels outside the hole/exclusions, same step indices
+    hist = None
+    if channels:
+        hist = IntensityHistogram.from_steps(steps[~excluded], step)
+        for channel in channels:
+            path = match_id(channel, ".tif", second_img_dir)
+            if path is None:
+                raise FileNotFoundError(f"No {channel} TIFF in {second_img_dir}")
+            hist.add_channel(channel, tiff.imread(path)[~excluded])
+
+    if preview_path is not None:
+        binned_dist_map = np.minimum(steps // factor + 1, n_bins + 1)
+        save_preview(
+            preview_path,
+            cp_centroids,
+            binned_dist_map=binned_dist_map,
+            hole_mask=hole_mask,
+        )
+
+    return density, count, area, hist
@@ -0,0 +1,192 @@
+"""Distance-binned neuron density analysis.
+
+Shared by ``notebooks/dist_analysis.ipynb`` and the batch workers: for one image,
+neuron centroids from the Cellpose prediction are binned by their distance from
+the implant hole defined in the SECOND mask.
+"""
+
+import h5py
+import numpy as np
+import pandas as pd
+import tifffile as tiff
+from matplotlib import pyplot as plt
+
+from masks import distance_map, read_config
+from objects import (
+    mask_factors,
+    object_table,
+    objects_path,
+    read_centroids,
+    table_centroids,
+)
+
+
+# read the mask in h5 format
+def read_h5_mask(mask_path):
+    with h5py.File(mask_path, "r") as f:
+        keys = list(f.keys())
+        exclusion_mask = f["exclusions"][:] if "exclusions" in keys else None
+        hole_mask = f["hole"][:]
+    return hole_mask, exclusion_mask
+
+
+def read_hole_labels(mask_path):
+    """Hole id per pixel (0 outside); masks without ``hole_labels`` have one hole."""
+    with h5py.File(mask_path, "r") as f:
+        if "hole_labels" in f:
+            return f["hole_labels"][:]
+        return f["hole"][:].astype(np.uint16)
+
+
+def extract_centroids(cp_pred, exclusion_mask, comp_fct=0.5):
+    # one centroid per label, the same rows as the object table
+    return table_centroids(object_table(cp_pred), exclusion_mask, comp_fct=comp_fct)
+
+
+def read_cp_mask(mask_path):
+    return tiff.imread(mask_path)
+
+
+def load_centroids(mask_path, exclusion_mask, comp_fct=0.5):
+    # use the object table written during prediction when available
+    table_path = objects_path(mask_path)
+    if table_path.exists():
+        return read_centroids(table_path, exclusion_mask, comp_fct=comp_fct)
+    cp_mask = read_cp_mask(mask_path)
+    return extract_centroids(cp_mask, exclusion_mask, comp_fct=comp_fct)
+
+
+def binned_analysis(binned, hole_mask, centroids, bins, comp_fct):
+    counts = np.zeros(len(bins) - 1)
+    area = np.zeros(len(bins) - 1)
+    hole_area = np.sum(hole_mask)
+    for i in range(1, len(bins)):
+        counts[i - 1] = np.sum(
+            binned[centroids[:, 1].astype(int), centroids[:, 0].astype(int)] == i
+        )
+        if i == 1:
+            area[i - 1] = (np.sum(binned == i) - hole_area) * comp_fct**2
+        else:
+            area[i - 1] = np.sum(binned == i) * comp_fct**2
+
+    return counts / area, counts, area
+
+
+def save_preview(
+    preview_path, centroids, binned_dist_map=None, hole_mask=None, hole=None, shape=None
+):
+    """Plot the distance bins (raster) or the hole outline (geometry) with centroids."""
+    if binned_dist_map is not None:
+        plt.imshow(binned_dist_map, cmap="viridis_r")
+        plt.imshow(np.ma.masked_where(~hole_mask, hole_mask), cmap="plasma", alpha=1)
+    else:
+        plt.fill(hole[:, 0], hole[:, 1], c="y")
+        plt.xlim(0, shape[1])
+        plt.ylim(shape[0], 0)
+        plt.gca().set_aspect("equal")
+    plt.scatter(centroids[:, 0], centroids[:, 1], c="r", s=1, marker=".", alpha=0.5)
+    plt.axis("off")
+    plt.savefig(preview_path, bbox_inches="tight", pad_inches=0, dpi=150)
+    plt.close()
+
+
+def analyze_image(
+    mask_path,
+    second_img_dir,
+    bins,
+    conv_fct,
+    comp_fct,
+    distance_mode="raster",
+    preview_path=None,
+):
+    """Density (per mm^2), count and area (mm^2) per distance bin for one image.
+
+    Factors recorded in the mask take precedence (see ``objects.mask_factors``).
+    """
+    conv_fct, mask_scale = mask_factors(mask_path, conv_fct, comp_fct)
+    second_mask_path = next(second_img_dir.glob("*_mask.h5"))
+
+    if distance_mode == "geometry":
+        # exact distances from the hole polygon; only the mask shape is read
+        from geometry import geometric_binned_analysis  # requires shapely
+
+        holes, exclusions = read_config(next(second_img_dir.glob("*_config.pickle")))
+        if len(holes) != 1:
+            raise ValueError(
+                f"Geometry mode needs exactly one hole, found {len(holes)}; "
+                "use the raster mode for several holes."
+            )
+        hole = holes[0]
+        with h5py.File(second_mask_path, "r") as f:
+            shape = f["hole"].shape
+        cp_centroids = load_centroids(mask_path, None, comp_fct=mask_scale)
+
+        density, count, area = geometric_binned_analysis(
+            hole, exclusions, cp_centroids, bins, shape, conv_fct, comp_fct
+        )
+        if preview_path is not None:
+            save_preview(preview_path, cp_centroids, hole=hole, shape=shape)
+    else:
+        # read the masks
+        hole_mask, exclusion_mask = read_h5_mask(second_mask_path)
+
+        # extract centroids
+        # combine the hole mask and exclusion mask
+        if exclusion_mask is not None:
+            exclusion_mask = hole_mask | exclusion_mask
+        else:
+            exclusion_mask = hole_mask
+        cp_centroids = load_centroids(mask_path, exclusion_mask, comp_fct=mask_scale)
+
+        # calculate the distance
+        dist_map = distance_map(hole_mask) * conv_fct
+        binned_dist_map = np.digitize(dist_map, bins)
+
+        density, count, area = binned_analysis(
+            binned_dist_map, hole_mask, cp_centroids, bins, comp_fct
+        )
+        if preview_path is not None:
+            save_preview(
+                preview_path,
+                cp_centroids,
+                binned_dist_map=binned_dist_map,
+                hole_mask=hole_mask,
+            )
+
+    density = density * 1e6  # convert to mm^2
+    area = area / 1e6  # convert to mm^2
+    return density, count, area
+
+
+def bin_labels(bins):
+    """Column names of the result tables, e.g. ``0-50``."""
+    return [f"{b}-{b + (bins[1] - bins[0])}" for b in bins[:-1]]
+
+
+def result_row(img_id, values, bins):
+    """One row of a result table: the image id followed by one value per bin."""
+    row = {"image_id": img_id}
+    row.update(zip(bin_labels(bins), values))
+    return row
+
+
+def hole_rows(img_id, values, bins):
+    """Rows of a per-hole table from per-hole values (row 0, all holes, is skipped)."""
+    rows = []
+    for hole_id, hole_values in enumerate(values[1:], start=1):
+        row = {"image_id": img_id, "hole": hole_id}
+        row.update(zip(bin_labels(bins), hole_values))
+        rows.append(row)
+    return rows
+
+
+def write_group_tables(
+    results_dir, group, density_rows, count_rows, area_rows, suffix=""
+):
+    """Write the density, count and area tables of one group as CSV."""
+    for name, rows in zip(
+        ("density", "count", "area"), (density_rows, count_rows, area_rows)
+    ):
+        pd.DataFrame(rows).to_csv(
+            results_dir / f"{group}_{name}{suffix}.csv", index=False
+        )
@@ -0,0 +1,140 @@
+"""Exact vector-geometry distance analysis based on saved ROI outlines.
+
+The GUI stores the implant hole and exclusions as polygon vertices in
+``<image_id>_config.pickle``.  Instead of rasterizing the polygons and running a
+full-image distance transform, centroid-to-hole distances are computed directly
+from the hole edges and annulus areas are computed analytically, so the cost
+scales with cell and vertex count rather than pixel count.
+"""
+
+import itertools
+
+import numpy as np
+from matplotlib.path import Path as PltPath
+from scipy.spatial import cKDTree
+from shapely.geometry import Polygon, box
+from shapely.ops import unary_union
+
+# Number of segments used to approximate a quarter circle when buffering
+QUAD_SEGS = 32
+
+
+def point_segment_distance(points, seg_start, seg_end):
+    """Row-wise Euclidean distance between points and line segments."""
+    seg = seg_end - seg_start
+    seg_len2 = np.einsum("ij,ij->i", seg, seg)
+    rel = points - seg_start
+    t = np.einsum("ij,ij->i", rel, seg) / np.where(seg_len2 > 0, seg_len2, 1)
+    t = np.clip(t, 0, 1)
+    closest = seg_start + t[:, None] * seg
+    return np.hypot(*(points - closest).T)
+
+
+class PolygonDistance:
+    """Nearest-edge distance queries against a closed polygon.
+
+    The distance to the nearest vertex is an upper bound on the distance to the
+    nearest edge, so only edges whose midpoint lies within that bound plus half
+    the longest edge length can be closest.  Those candidates are looked up in a
+    KD-tree over edge midpoints and evaluated in one vectorized pass.
+    """
+
+    def __init__(self, vertices):
+        self.start = np.asarray(vertices, dtype=float)
+        self.end = np.roll(self.start, -1, axis=0)
+        self.path = PltPath(self.start)
+
+        half_len = np.hypot(*(self.end - self.start).T) / 2
+        self._max_half_len = half_len.max()
+        self._vertex_tree = cKDTree(self.start)
+        self._edge_tree = cKDTree((self.start + self.end) / 2)
+
+    def contains(self, points):
+        """Return True for points inside the polygon (same test as the H5 rasterization)."""
+        return self.path.contains_points(points)
+
+    def distance(self, points):
+        """Distance in pixels from each point to the polygon; 0 inside the polygon."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(points) == 0:
+            return np.zeros(0)
+
+        d_vertex, _ = self._vertex_tree.query(points)
+        candidates = self._edge_tree.query_ball_point(
+            points, d_vertex + self._max_half_len, return_sorted=False
+        )
+
+        counts = np.fromiter(map(len, candidates), dtype=int, count=len(points))
+        point_idx = np.repeat(np.arange(len(points)), counts)
+        edge_idx = np.fromiter(
+            itertools.chain.from_iterable(candidates), dtype=int, count=counts.sum()
+        )
+
+        d = point_segment_distance(
+            points[point_idx], self.start[edge_idx], self.end[edge_idx]
+        )
+        # every point has at least one candidate edge, so the groups are contiguous
+        dist = np.minimum.reduceat(d, np.cumsum(counts) - counts)
+        dist[self.contains(points)] = 0
+        return dist
+
+
+def filter_centroids(centroids, hole, exclusions):
+    """Drop centroids that fall inside the hole or any exclusion polygon."""
+    keep = np.ones(len(centroids), dtype=bool)
+    for vertices in [hole, *exclusions]:
+        keep &= ~PltPath(vertices).contains_points(centroids)
+    return centroids[keep]
+
+
+def _as_polygon(vertices):
+    """Build a valid shapely polygon from hand-drawn (possibly self-intersecting) vertices."""
+    polygon = Polygon(vertices)
+    return polygon if polygon.is_valid else polygon.buffer(0)
+
+
+def annulus_areas(hole, exclusions, bins_px, shape):
+    """Area in pixels of each distance annulus around the hole.
+
+    Annuli are built by buffering the hole polygon, then clipped to the image
+    bounds and to the complement of the exclusions.  Pixel centers sit on
+    integer coordinates, so the image covers ``[-0.5, n - 0.5]`` on each axis.
+    """
+    hole_poly = _as_polygon(hole)
+    ny, nx = shape[:2]
+    allowed = box(-0.5, -0.5, nx - 0.5, ny - 0.5)
+    if exclusions:
+        allowed = allowed.difference(
+            unary_union([_as_polygon(vertices) for vertices in exclusions])
+        )
+
+    rings = [
+        hole_poly if r == 0 else hole_poly.buffer(r, quad_segs=QUAD_SEGS)
+        for r in bins_px
+    ]
+    return np.array(
+        [
+            outer.difference(inner).intersection(allowed).area
+            for inner, outer in zip(rings[:-1], rings[1:])
+        ]
+    )
+
+
+def geometric_binned_analysis(
+    hole, exclusions, centroids, bins, shape, conv_fct, comp_fct
+):
+    """Geometric counterpart of ``distance.binned_analysis``.
+
+    ``centroids`` are (x, y) coordinates in SECOND-mask pixels, ``bins`` are in
+    microns and ``shape`` is the SECOND-mask shape.  Returns density, counts and
+    area in the same units as the raster analysis.
+    """
+    centroids = filter_centroids(centroids, hole, exclusions)
+    dist_um = PolygonDistance(hole).distance(centroids) * conv_fct
+
+    binned = np.digitize(dist_um, bins)
+    counts = np.bincount(binned, minlength=len(bins) + 1)[1 : len(bins)].astype(float)
+    area = annulus_areas(hole, exclusions, np.asarray(bins) / conv_fct, shape)
+    area = area * comp_fct**2
+
+    return counts / area, counts, area
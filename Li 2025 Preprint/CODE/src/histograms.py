@@ -0,0 +1,218 @@
+"""Fine-step intensity histograms that can be re-binned without image I/O.
+
+For every image the intensity analysis stores, per distance step, the pixel
+count and the per-channel intensity sum and sum of squares in
+``<image_id>_intensity-hist.h5`` next to the mask.  Any coarser bin width,
+upper limit or normalization can then be derived from these files alone:
+
+    python src/histograms.py <folder> --channels AF488,AF594 --norm 1,0 --bin 100
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import tifffile as tiff
+
+from masks import distance_map
+
+HIST_SUFFIX = "_intensity-hist.h5"
+
+
+class IntensityHistogram:
+    """Per-step pixel count and per-channel intensity sums for one image."""
+
+    def __init__(self, step, count, sums=None, sumsq=None):
+        self.step = step
+        self.count = np.asarray(count, dtype=np.int64)
+        self.sums = sums if sums is not None else {}
+        self.sumsq = sumsq if sumsq is not None else {}
+        self._index = None
+
+    @classmethod
+    def from_distances(cls, dist_um, step):
+        """Start a histogram from the (unmasked) pixel distances of one image."""
+        return cls.from_steps((np.asarray(dist_um) // step).astype(np.intp), step)
+
+    @classmethod
+    def from_steps(cls, index, step):
+        """Start a histogram from precomputed fine-step indices of the pixels."""
+        hist = cls(step, np.bincount(index))
+        hist._index = index
+        return hist
+
+    def add_channel(self, name, values):
+        """Accumulate intensity sum and sum of squares for the pixels given to ``from_distances``."""
+        values = np.asarray(values, dtype=np.float64)
+        n_steps = len(self.count)
+        self.sums[name] = np.bincount(self._index, weights=values, minlength=n_steps)
+        self.sumsq[name] = np.bincount(
+            self._index, weights=values**2, minlength=n_steps
+        )
+
+    def rebin(self, channel, bin_width, upper_limit):
+        """Pixel-weighted mean, standard deviation and pixel count per coarse bin."""
+        factor, n_bins = fold_shape(self.step, bin_width, upper_limit)
+        count = fold(self.count, factor, n_bins)
+        total = fold(self.sums[channel], factor, n_bins)
+        total_sq = fold(self.sumsq[channel], factor, n_bins)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+            var = total_sq / count - mean**2
+        return mean, np.sqrt(np.clip(var, 0, None)), count
+
+    def save(self, path, **attrs):
+        """Write the histogram to HDF5; extra keyword arguments are stored as attributes."""
+        with h5py.File(path, "w") as hf:
+            hf.attrs["step_um"] = self.step
+            for key, value in attrs.items():
+                hf.attrs[key] = value
+            hf.create_dataset("count", data=self.count, compression="gzip")
+            for name in self.sums:
+                grp = hf.create_group(name)
+                grp.create_dataset("sum", data=self.sums[name], compression="gzip")
+                grp.create_dataset("sumsq", data=self.sumsq[name], compression="gzip")
+
+    @classmethod
+    def load(cls, path):
+        """Read a histogram written by ``save``."""
+        with h5py.File(path, "r") as hf:
+            channels = [key for key in hf if isinstance(hf[key], h5py.Group)]
+            return cls(
+                hf.attrs["step_um"],
+                hf["count"][:],
+                {ch: hf[ch]["sum"][:] for ch in channels},
+                {ch: hf[ch]["sumsq"][:] for ch in channels},
+            )
+
+
+def fold_shape(step, bin_width, upper_limit):
+    """Number of fine steps per bin and number of bins, checking they divide evenly."""
+    factor = bin_width / step
+    if factor < 1 or not np.isclose(factor, round(factor)):
+        raise ValueError(
+            f"Bin width {bin_width} is not a multiple of the stored step {step}."
+        )
+    n_bins = int(upper_limit // bin_width)
+    if not np.isclose(n_bins * bin_width, upper_limit):
+        raise ValueError(
+            f"Upper limit {upper_limit} is not a multiple of bin width {bin_width}."
+        )
+    return int(round(factor)), n_bins
+
+
+def fold(arr, factor, n_bins):
+    """Pad/truncate fine steps to ``n_bins * factor`` and sum groups of ``factor``."""
+    padded = np.zeros(n_bins * factor)
+    n = min(len(arr), len(padded))
+    padded[:n] = arr[:n]
+    return padded.reshape(n_bins, factor).sum(axis=1)
+
+
+def match_id(identifier, file_ext, search_path):
+    """Find file matching identifier and extension. Returns last match if multiple found."""
+    matches = list(Path(search_path).rglob(f"*{identifier}*{file_ext}"))
+    return matches[-1] if matches else None
+
+
+def find_intensity_inputs(data_path, channels):
+    """List (image_id, mask_path, channel_paths) for masks with a TIFF for every channel."""
+    batch = []
+    for mask_path in Path(data_path).rglob("*_mask.h5"):
+        channel_paths = [match_id(ch, ".tif", mask_path.parent) for ch in channels]
+        if None not in channel_paths:
+            batch.append((mask_path.parent.name, mask_path, channel_paths))
+    return batch
+
+
+def unpack_h5(file_path):
+    """Extract hole and combined mask data from HDF5 file."""
+    with h5py.File(file_path, "r") as f:
+        return f["hole"][:], np.logical_or(f["hole"][:], f["exclusions"][:])
+
+
+def image_histogram(map_hole, mask_all, channels, channel_files, step, conv_factor):
+    """Fine-step histogram of one image from its SECOND masks and channel TIFFs."""
+    # Calculate distance from hole for each pixel
+    dist_2d_pixels = distance_map(map_hole)
+    dist_1d_um = (
+        np.ma.array(dist_2d_pixels, mask=mask_all).compressed()
+    ) * conv_factor
+
+    hist = IntensityHistogram.from_distances(dist_1d_um, step)
+    for channel, path in zip(channels, channel_files):
+        img = tiff.imread(path)
+        hist.add_channel(channel, np.ma.array(img, mask=mask_all).compressed())
+    return hist
+
+
+def normalize(means, norm):
+    """Normalize bin means to the outermost bin, as in the GUI intensity export."""
+    return np.clip(means / means[-1] - (1 - norm), 0, None)
+
+
+def find_histograms(folder):
+    """Yield (image_id, histogram) for every stored histogram under ``folder``."""
+    for path in sorted(Path(folder).rglob(f"*{HIST_SUFFIX}")):
+        yield path.name[: -len(HIST_SUFFIX)], IntensityHistogram.load(path)
+
+
+def intensity_tables(hists, image_ids, channels, norms, bin_width, upper_limit):
+    """Build one normalized intensity table per channel from stored histograms."""
+    headers = [
+        f"{x}-{x + bin_width}" for x in np.arange(0, upper_limit, bin_width)
+    ]
+    tables = {}
+    for channel, norm in zip(channels, norms):
+        rows = [
+            normalize(hist.rebin(channel, bin_width, upper_limit)[0], norm)
+            for hist in hists
+        ]
+        df = pd.DataFrame(data=rows, index=image_ids, columns=headers)
+        df.index.name = "id"
+        tables[channel] = df
+    return tables
+
+
+def write_tables(tables, path):
+    """Write per-channel tables to an Excel workbook, one sheet per channel."""
+    with pd.ExcelWriter(path) as writer:
+        for channel, df in tables.items():
+            df.to_excel(writer, sheet_name=channel)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-aggregate stored intensity histograms without reading images."
+    )
+    parser.add_argument("folder", type=Path)
+    parser.add_argument("--channels", required=True, help="e.g. AF488,AF594")
+    parser.add_argument("--norm", required=True, help="e.g. 1,0")
+    parser.add_argument("--bin", type=int, default=50, help="bin width (um)")
+    parser.add_argument("--up-lim", type=int, default=700, help="upper limit (um)")
+    args = parser.parse_args()
+
+    channels = [ch for ch in args.channels.replace(" ", "").split(",") if ch]
+    norms = [float(n) for n in args.norm.replace(" ", "").split(",") if n]
+    if len(channels) != len(norms):
+        parser.error("Channel names and normalization constants must match.")
+
+    image_ids, hists = [], []
+    for image_id, hist in find_histograms(args.folder):
+        image_ids.append(image_id)
+        hists.append(hist)
+    if not hists:
+        parser.error(f"No *{HIST_SUFFIX} files found under {args.folder}.")
+
+    tables = intensity_tables(hists, image_ids, channels, norms, args.bin, args.up_lim)
+    output_filename = f"{time.strftime('%Y%m%d-%H%M%S')}_intensity-raw-output.xlsx"
+    write_tables(tables, args.folder / output_filename)
+    print(f"{len(hists)} images written to {args.folder / output_filename}")
+
+
+if __name__ == "__main__":
+    main()
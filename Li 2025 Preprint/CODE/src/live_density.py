@@ -0,0 +1,342 @@
+"""Live per-bin neuron density while annotating holes and exclusions.
+
+``LiveDensity`` keeps everything that does not depend on the ROI being edited:
+the neuron centroids are loaded once, the binned distance map is cached per
+set of hole outlines, and exclusions are tracked as a per-pixel coverage count so that
+adding, moving or deleting one exclusion only touches its bounding box.  The
+distance map for edited holes is recomputed in a worker thread once the edits
+pause, so dragging a hole never blocks the GUI.
+Results follow ``distance.binned_analysis`` (raster mode), so the numbers match
+``dist_analysis.ipynb``.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import (
+    QCheckBox,
+    QFileDialog,
+    QFormLayout,
+    QLabel,
+    QLineEdit,
+    QPushButton,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+    QWidget,
+)
+
+from distance import load_centroids
+from masks import distance_map, label_holes, rasterize_bbox
+from objects import mask_factors
+
+# Pause after the last hole edit before the distance map is recomputed (ms)
+HOLE_DEBOUNCE_MS = 50
+
+
+class LiveDensity:
+    """Incrementally updated distance-binned counts, areas and densities."""
+
+    def __init__(self, shape, centroids, bins, conv_fct, comp_fct):
+        self.shape = tuple(shape[:2])
+        self.bins = np.asarray(bins)
+        self.conv_fct = conv_fct
+        self.comp_fct = comp_fct
+        self.n_bins = len(self.bins) + 1  # digitize indices 0 .. len(bins)
+
+        centroids = np.asarray(centroids).reshape(-1, 2)
+        self.cx = np.clip(centroids[:, 0].astype(int), 0, self.shape[1] - 1)
+        self.cy = np.clip(centroids[:, 1].astype(int), 0, self.shape[0] - 1)
+
+        self.coverage = np.zeros(self.shape, dtype=np.uint8)
+        self.exclusions = {}  # key -> (y0, x0, local raster)
+
+        self.hole_mask = None
+        self.binned = None
+        self.base_area = np.zeros(self.n_bins, dtype=np.int64)
+        self.excluded_area = np.zeros(self.n_bins, dtype=np.int64)
+        self.centroid_bins = None
+
+    def set_holes(self, polygons):
+        """Recompute the distance map for new hole outlines (the only full pass)."""
+        self.apply_holes(self.hole_maps(polygons))
+
+    def hole_maps(self, polygons):
+        """Hole mask, binned distance map and per-bin area of hole outlines.
+
+        Does not touch the incremental state, so it can run in a worker thread.
+        """
+        if not polygons:
+            return None
+        hole_mask = label_holes(polygons, self.shape) > 0
+        dist_map = distance_map(hole_mask)
+        binned = np.digitize(dist_map * self.conv_fct, self.bins).astype(np.uint16)
+
+        base_area = np.bincount(binned.ravel(), minlength=self.n_bins)
+        base_area[1] -= np.count_nonzero(hole_mask)
+        return hole_mask, binned, base_area
+
+    def apply_holes(self, maps):
+        """Switch to maps from ``hole_maps`` and re-bin the exclusions and neurons."""
+        if maps is None:
+            self.hole_mask = None
+            self.binned = None
+            return
+
+        self.hole_mask, self.binned, self.base_area = maps
+        outside = (self.coverage > 0) & ~self.hole_mask
+        self.excluded_area = np.bincount(self.binned[outside], minlength=self.n_bins)
+        self.centroid_bins = self.binned[self.cy, self.cx]
+
+    def set_exclusion(self, key, points):
+        """Add or move an exclusion, updating only the pixels of its old and new boxes."""
+        self.remove_exclusion(key)
+        y0, x0, local = rasterize_bbox(points, self.shape)
+        self.exclusions[key] = (y0, x0, local)
+        self._apply(y0, x0, local, 1)
+
+    def remove_exclusion(self, key):
+        """Remove an exclusion if it exists."""
+        if key in self.exclusions:
+            self._apply(*self.exclusions.pop(key), -1)
+
+    def _apply(self, y0, x0, local, delta):
+        h, w = local.shape
+        window = (slice(y0, y0 + h), slice(x0, x0 + w))
+        cov = self.coverage[window]
+
+        # pixels whose excluded state flips: 0 -> 1 when adding, 1 -> 0 when removing
+        changed = local & (cov == (0 if delta > 0 else 1))
+        if delta > 0:
+            cov[local] += 1
+        else:
+            cov[local] -= 1
+
+        if self.binned is not None:
+            changed &= ~self.hole_mask[window]
+            self.excluded_area += delta * np.bincount(
+                self.binned[window][changed], minlength=self.n_bins
+            )
+
+    def result(self, subtract_exclusions=False):
+        """Density (per mm^2), count and area (mm^2) per bin, as in ``dist_analysis``.
+
+        The notebook's raster analysis removes neurons in exclusions but keeps
+        the excluded area; ``subtract_exclusions`` also removes the area, as the
+        geometry mode does.
+        """
+        n = len(self.bins) - 1
+        if self.binned is None:
+            return np.full(n, np.nan), np.zeros(n), np.full(n, np.nan)
+
+        excluded = (self.coverage[self.cy, self.cx] > 0) | self.hole_mask[
+            self.cy, self.cx
+        ]
+        counts = np.bincount(self.centroid_bins[~excluded], minlength=self.n_bins)
+        counts = counts[1 : n + 1].astype(float)
+
+        area = self.base_area[1 : n + 1].astype(float)
+        if subtract_exclusions:
+            area = area - self.excluded_area[1 : n + 1]
+        area = area * self.comp_fct**2
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            density = counts / area * 1e6  # convert to mm^2
+        return density, counts, area / 1e6
+
+
+class DensityPanel(QWidget):
+    """Window showing per-bin neuron count, area and density for the open image set."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.ui = None
+        self.engine = None
+        self.mask_root = None
+
+        # hole edits are debounced and recomputed off the GUI thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="density")
+        self.hole_job = None  # (engine, future) of the running recompute
+        self.hole_dirty = False
+        self.hole_t0 = None
+        self.hole_timer = QTimer(self)
+        self.hole_timer.setSingleShot(True)
+        self.hole_timer.setInterval(HOLE_DEBOUNCE_MS)
+        self.hole_timer.timeout.connect(self.startHoleUpdate)
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(20)
+        self.poll_timer.timeout.connect(self.finishHoleUpdate)
+
+        layout = QVBoxLayout()
+        form = QFormLayout()
+
+        self.le_conv_fct = QLineEdit("0.344")
+        self.le_comp_fct = QLineEdit("0.5")
+        self.le_bin_width = QLineEdit("50")
+        self.le_up_lim = QLineEdit("1000")
+        form.addRow(QLabel("Conversion Factor (um/pixel):"), self.le_conv_fct)
+        form.addRow(QLabel("Compression Factor:"), self.le_comp_fct)
+        form.addRow(QLabel("Bin Width (um):"), self.le_bin_width)
+        form.addRow(QLabel("Upper Limit (um):"), self.le_up_lim)
+        layout.addLayout(form)
+
+        self.subtract_box = QCheckBox("Subtract exclusion area (geometry mode)")
+        self.subtract_box.stateChanged.connect(self.refresh)
+        layout.addWidget(self.subtract_box)
+
+        self.load_button = QPushButton("Load Neuron Mask")
+        self.load_button.clicked.connect(self.chooseMask)
+        layout.addWidget(self.load_button)
+
+        self.status_label = QLabel("No neuron mask loaded")
+        layout.addWidget(self.status_label)
+
+        self.table = QTableWidget(0, 3)
+        self.table.setHorizontalHeaderLabels(
+            ["Count", "Area (mm^2)", "Density (/mm^2)"]
+        )
+        layout.addWidget(self.table)
+
+        self.setLayout(layout)
+        self.setWindowTitle("Live Density")
+
+    def setImageSet(self, ui):
+        """Attach to the main window's current image set, reusing the last mask folder."""
+        self.ui = ui
+        self.engine = None
+        self.table.setRowCount(0)
+        self.status_label.setText("No neuron mask loaded")
+
+        if self.mask_root is not None and ui.image_path_list:
+            image_id = ui.image_path_list[0].parent.name
+            for pattern in (f"{image_id}_objects.parquet", f"{image_id}_masks.tif"):
+                match = next(self.mask_root.rglob(pattern), None)
+                if match is not None:
+                    self.loadMask(match)
+                    break
+
+    def chooseMask(self):
+        """Pick the Cellpose mask (or object table) belonging to the open image set."""
+        if self.ui is None or not self.ui.image_path_list:
+            return
+        fname, _ = QFileDialog.getOpenFileName(
+            self,
+            "Open the neuron mask",
+            str(self.mask_root or self.ui.image_path_list[0].parent),
+            "Neuron masks (*_masks.tif *_objects.parquet)",
+        )
+        if fname:
+            self.loadMask(fname)
+
+    def loadMask(self, path):
+        """Load centroids once and build the engine from the current ROIs."""
+        path = Path(path)
+        self.mask_root = path.parent.parent
+        mask_path = path.with_name(path.name.replace("_objects.parquet", "_masks.tif"))
+
+        conv_fct = float(self.le_conv_fct.text())
+        comp_fct = float(self.le_comp_fct.text())
+        mask_scale = comp_fct
+        if mask_path.exists():
+            # factors recorded with the mask, see objects.mask_factors
+            conv_fct, mask_scale = mask_factors(mask_path, conv_fct, comp_fct)
+            self.le_conv_fct.setText(f"{conv_fct:g}")
+        bin_width = float(self.le_bin_width.text())
+        upper_limit = float(self.le_up_lim.text())
+        bins = np.arange(0, upper_limit + bin_width, bin_width)
+
+        nx, ny = self.ui.image_data_list[0].shape[:2]
+        centroids = load_centroids(mask_path, None, comp_fct=mask_scale)
+        self.engine = LiveDensity((ny, nx), centroids, bins, conv_fct, comp_fct)
+        self.table.setRowCount(len(bins) - 1)
+        self.table.setVerticalHeaderLabels(
+            [f"{b:g}-{b + bin_width:g}" for b in bins[:-1]]
+        )
+        self.syncAll()
+
+    def syncAll(self):
+        """Rebuild hole and exclusions from the main window's ROIs."""
+        if self.engine is None:
+            return
+        t0 = time.perf_counter()
+        for key in list(self.engine.exclusions):
+            self.engine.remove_exclusion(key)
+        for key, roi in self.ui.masks_dict.items():
+            self.engine.set_exclusion(key, roi.saveState()["points"])
+        self.engine.set_holes(self.holePolygons())
+        self.refresh(t0=t0)
+
+    def holePolygons(self):
+        return [roi.saveState()["points"] for roi in self.ui.holes_dict.values()]
+
+    def holeChanged(self):
+        """Schedule the distance map update for when the hole edits pause."""
+        if self.engine is None:
+            return
+        if self.hole_t0 is None:
+            self.hole_t0 = time.perf_counter()
+        self.hole_timer.start()
+
+    def startHoleUpdate(self):
+        if self.engine is None:
+            return
+        if self.hole_job is not None:
+            # restarted with the latest outlines when the running one finishes
+            self.hole_dirty = True
+            return
+        future = self.executor.submit(self.engine.hole_maps, self.holePolygons())
+        self.hole_job = (self.engine, future)
+        self.poll_timer.start()
+
+    def finishHoleUpdate(self):
+        engine, future = self.hole_job
+        if not future.done():
+            return
+        self.poll_timer.stop()
+        self.hole_job = None
+
+        if engine is not self.engine:  # a new mask was loaded meanwhile
+            self.hole_dirty = False
+            self.hole_t0 = None
+            return
+        engine.apply_holes(future.result())
+        if self.hole_dirty:
+            self.hole_dirty = False
+            self.startHoleUpdate()
+            self.refresh()
+        else:
+            t0, self.hole_t0 = self.hole_t0, None
+            self.refresh(t0=t0)
+
+    def exclusionChanged(self, key):
+        if self.engine is None:
+            return
+        t0 = time.perf_counter()
+        if key in self.ui.masks_dict:
+            points = self.ui.masks_dict[key].saveState()["points"]
+            self.engine.set_exclusion(key, points)
+        else:
+            self.engine.remove_exclusion(key)
+        self.refresh(t0=t0)
+
+    def refresh(self, *args, t0=None):
+        """Redraw the table from the engine's current state."""
+        if self.engine is None:
+            return
+        density, count, area = self.engine.result(self.subtract_box.isChecked())
+        formats = ("{:.0f}", "{:.4f}", "{:.1f}")
+        for row, values in enumerate(zip(count, area, density)):
+            for col, (value, fmt) in enumerate(zip(values, formats)):
+                self.table.setItem(row, col, QTableWidgetItem(fmt.format(value)))
+
+        total = int(count.sum())
+        if self.engine.binned is None:
+            self.status_label.setText("Draw the implant hole to see densities")
+        elif t0 is not None:
+            elapsed = (time.perf_counter() - t0) * 1000
+            self.status_label.setText(f"{total} neurons, updated in {elapsed:.0f} ms")
+        else:
+            self.status_label.setText(f"{total} neurons")
@@ -0,0 +1,129 @@
+"""SECOND mask I/O: GUI configuration files and their rasterization.
+
+``<image_id>_config.pickle`` holds the hole and exclusion outlines as polygon
+vertices; ``<image_id>_mask.h5`` holds them rasterized as boolean ``hole`` and
+``exclusions`` datasets in image pixel coordinates.  An image may have several
+holes (e.g. the shanks of one device): ``hole`` is then their union and
+``hole_labels`` numbers them 1, 2, ... in the order they were saved.
+"""
+
+import pickle as pkl
+
+import cv2
+import h5py
+import numpy as np
+from scipy import ndimage
+
+
+def _as_vertices(points):
+    """Convert ROI handle positions (tuples or pyqtgraph Points) to an (N, 2) array."""
+    return np.array([[p[0], p[1]] for p in points], dtype=float)
+
+
+def hole_states(master_dict):
+    """ROI states of the holes in a configuration (older files hold a single one)."""
+    if "holes_states" in master_dict:
+        return master_dict["holes_states"]
+    return [master_dict["hole"]] if master_dict["hole"] is not None else []
+
+
+def read_config(config_path):
+    """Read the hole and exclusion polygon vertices from a GUI configuration file."""
+    with open(config_path, "rb") as f:
+        master_dict = pkl.load(f)
+
+    holes = [_as_vertices(state["points"]) for state in hole_states(master_dict)]
+    exclusions = [
+        _as_vertices(state["points"]) for state in master_dict["exclusions_states"]
+    ]
+    return holes, exclusions
+
+
+def rasterize_bbox(points, shape):
+    """Rasterize a polygon within its bounding box.
+
+    Returns ``(y0, x0, grid)`` where ``grid`` marks the pixels of the box whose
+    centers lie inside the polygon (even-odd rule, scanned row by row); the box
+    is clipped to the image.  Centers exactly on an edge count as inside on the
+    left and top edges only.
+    """
+    vertices = _as_vertices(points)
+    ny, nx = shape[:2]
+
+    x0, y0 = np.maximum(np.floor(vertices.min(axis=0)).astype(int), 0)
+    x1, y1 = np.minimum(np.ceil(vertices.max(axis=0)).astype(int) + 1, [nx, ny])
+    if x0 >= x1 or y0 >= y1:
+        return 0, 0, np.full((0, 0), False)
+
+    # even-odd scanline: each edge crossing a row toggles the pixels right of it
+    start, end = vertices, np.roll(vertices, -1, axis=0)
+    rows = np.arange(y0, y1)[:, None]
+    lo, hi = np.minimum(start[:, 1], end[:, 1]), np.maximum(start[:, 1], end[:, 1])
+    crosses = (lo <= rows) & (rows < hi)
+    r, e = np.nonzero(crosses)
+    t = (rows[r, 0] - start[e, 1]) / (end[e, 1] - start[e, 1])
+    xc = start[e, 0] + t * (end[e, 0] - start[e, 0])
+    cols = np.clip(np.ceil(xc - x0).astype(int), 0, x1 - x0)
+
+    toggles = np.zeros((y1 - y0, x1 - x0 + 1), dtype=np.uint8)
+    np.bitwise_xor.at(toggles, (r, cols), 1)
+    inside = np.logical_xor.accumulate(toggles[:, :-1].view(bool), axis=1)
+    return y0, x0, inside
+
+
+def rasterize(points, shape):
+    """Boolean mask of the pixels whose centers lie inside a polygon.
+
+    Only the polygon's bounding box is scanned (see ``rasterize_bbox``).
+    """
+    grid = np.full(shape[:2], False)
+    y0, x0, local = rasterize_bbox(points, shape)
+    grid[y0 : y0 + local.shape[0], x0 : x0 + local.shape[1]] = local
+    return grid
+
+
+def label_holes(holes, shape):
+    """Hole id per pixel: 0 outside, ``k`` inside the k-th polygon (later on top)."""
+    labels = np.zeros(shape[:2], dtype=np.uint16)
+    for k, vertices in enumerate(holes, start=1):
+        y0, x0, local = rasterize_bbox(vertices, shape)
+        labels[y0 : y0 + local.shape[0], x0 : x0 + local.shape[1]][local] = k
+    return labels
+
+
+def distance_map(hole_mask):
+    """Exact Euclidean distance in pixels from every pixel to the nearest hole pixel."""
+    return cv2.distanceTransform(
+        (~hole_mask).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE
+    )
+
+
+def nearest_hole(hole_labels):
+    """Distance in pixels to the nearest hole pixel and the id of that hole.
+
+    A single exact distance transform that also returns the position of the
+    nearest hole pixel, whose label attributes every pixel to one hole.
+    """
+    dist, (iy, ix) = ndimage.distance_transform_edt(
+        hole_labels == 0, return_indices=True
+    )
+    return dist.astype(np.float32), hole_labels[iy, ix]
+
+
+def write_mask_datasets(h5_file, hole_labels, exclusions):
+    """Write the ``hole``, ``hole_labels`` and ``exclusions`` datasets."""
+    h5_file.create_dataset("hole", data=hole_labels > 0, compression="gzip")
+    h5_file.create_dataset("hole_labels", data=hole_labels, compression="gzip")
+    h5_file.create_dataset("exclusions", data=exclusions, compression="gzip")
+
+
+def write_h5_mask(config_path, h5_path, shape):
+    """Rasterize a GUI configuration into the ``_mask.h5`` layout without the GUI."""
+    holes, exclusions = read_config(config_path)
+
+    excl_grid = np.full(shape, False)
+    for vertices in exclusions:
+        excl_grid |= rasterize(vertices, shape)
+
+    with h5py.File(h5_path, "w") as hf:
+        write_mask_datasets(hf, label_holes(holes, shape), excl_grid)
@@ -0,0 +1,130 @@
+"""Per-image object tables emitted alongside the Cellpose masks.
+
+Prediction can write ``<image>_objects.parquet`` next to ``<image>_masks.tif``
+with one row per labelled neuron (label id, centroid, area, bounding box).  The
+distance analysis reads centroids from this table instead of decoding the full
+mask and re-running connected components.
+
+The ``_masks.tif`` itself records the resolution it was predicted at: ``scale``
+is mask pixels per SECOND-image pixel (the compression factor) and
+``pixel_size_um`` the size of one mask pixel.  Masks from before these were
+recorded fall back to the factors given to the analysis.
+"""
+
+import numpy as np
+import pandas as pd
+import tifffile as tiff
+from scipy import ndimage
+
+OBJECTS_SUFFIX = "_objects.parquet"
+COLUMNS = ["label", "centroid_x", "centroid_y", "area", "y0", "x0", "y1", "x1"]
+
+
+def write_masks(path, masks, scale=None, pixel_size_um=None):
+    """Write a ``_masks.tif``, recording its scale and pixel size when given."""
+    metadata = {}
+    if scale is not None:
+        metadata = {"scale": scale, "pixel_size_um": pixel_size_um}
+    tiff.imwrite(path, masks, compression="zlib", metadata=metadata)
+
+
+def read_mask_scale(mask_path):
+    """``(scale, pixel_size_um)`` recorded in a ``_masks.tif``, or None."""
+    with tiff.TiffFile(mask_path) as tif:
+        metadata = tif.shaped_metadata
+    if metadata and "scale" in metadata[0]:
+        return metadata[0]["scale"], metadata[0]["pixel_size_um"]
+    return None
+
+
+def mask_factors(mask_path, conv_fct=None, comp_fct=None):
+    """Conversion factor (um per SECOND pixel) and scale of a mask's coordinates.
+
+    Values recorded at prediction take precedence over the arguments, which
+    are only used for masks without them.  The scale places the centroids in
+    SECOND pixels; areas keep the caller's ``comp_fct`` so that masks predicted
+    at different scales give comparable densities.
+    """
+    recorded = read_mask_scale(mask_path)
+    if recorded is None:
+        return conv_fct, comp_fct
+    scale, pixel_size_um = recorded
+    if pixel_size_um is not None:
+        conv_fct = pixel_size_um * scale
+    return conv_fct, scale
+
+
+def objects_path(mask_path):
+    """Path of the object table belonging to a ``_masks.tif`` file."""
+    return mask_path.with_name(mask_path.stem.replace("_masks", "") + OBJECTS_SUFFIX)
+
+
+def object_table(masks, chunk_rows=1024):
+    """Label id, centroid (x, y), area and bounding box of every object in a label image."""
+    masks = np.asarray(masks)
+    ny, nx = masks.shape
+    n = int(masks.max()) + 1 if masks.size else 1
+
+    # accumulate in row blocks so the coordinate weights stay small
+    area = np.zeros(n, dtype=np.int64)
+    sum_x = np.zeros(n)
+    sum_y = np.zeros(n)
+    for r0 in range(0, ny, chunk_rows):
+        block = masks[r0 : r0 + chunk_rows]
+        labels = block.ravel()
+        area += np.bincount(labels, minlength=n)
+        sum_x += np.bincount(
+            labels, weights=np.tile(np.arange(nx), len(block)), minlength=n
+        )
+        sum_y += np.bincount(
+            labels, weights=np.repeat(np.arange(r0, r0 + len(block)), nx), minlength=n
+        )
+
+    ids = np.flatnonzero(area[1:]) + 1
+    slices = ndimage.find_objects(masks)
+    bbox = np.array(
+        [
+            (sl[0].start, sl[1].start, sl[0].stop, sl[1].stop)
+            for sl in (slices[i - 1] for i in ids)
+        ],
+        dtype=np.int32,
+    ).reshape(-1, 4)
+
+    return pd.DataFrame(
+        {
+            "label": ids.astype(np.int32),
+            "centroid_x": sum_x[ids] / area[ids],
+            "centroid_y": sum_y[ids] / area[ids],
+            "area": area[ids].astype(np.int32),
+            "y0": bbox[:, 0],
+            "x0": bbox[:, 1],
+            "y1": bbox[:, 2],
+            "x1": bbox[:, 3],
+        },
+        columns=COLUMNS,
+    )
+
+
+def write_object_table(masks, path):
+    """Compute and write the object table of a label image."""
+    object_table(masks).to_parquet(path, index=False)
+
+
+def read_centroids(path, exclusion_mask=None, comp_fct=0.5):
+    """Read (x, y) centroids in SECOND-mask pixels, dropping those inside the exclusion mask."""
+    table = pd.read_parquet(path, columns=["centroid_x", "centroid_y"])
+    return table_centroids(table, exclusion_mask, comp_fct)
+
+
+def table_centroids(table, exclusion_mask=None, comp_fct=0.5):
+    """Centroids of an object table in SECOND-mask pixels, as ``read_centroids``."""
+    centroids = table[["centroid_x", "centroid_y"]].to_numpy() / comp_fct
+
+    if exclusion_mask is not None:
+        y_centroids = centroids[:, 1].astype(int)
+        x_centroids = centroids[:, 0].astype(int)
+
+        masked_pts = exclusion_mask[y_centroids, x_centroids]
+        centroids = centroids[~masked_pts]
+
+    return centroids
@@ -0,0 +1,133 @@
+"""CPU and memory budget shared by the pipeline runners.
+
+The pipeline mixes torch (Cellpose), OpenCV, NumPy/SciPy BLAS and the zlib
+codecs of tifffile, and each of them starts about one thread per core in every
+process.  Parallelizing by processes therefore oversubscribes the node unless
+every worker is capped.  ``ResourceConfig`` holds the node budget (cores and
+memory) and the threads a worker of each stage may use; ``limit_threads``
+applies the cap inside a worker, and ``ResourceConfig.workers`` sizes a stage's
+pool from the measured per-image peak memory of its workers.
+
+The budget can be kept in a JSON file shared by all runners, e.g.::
+
+    {"cpus": 32, "memory_gb": 100,
+     "threads": {"segment": 8, "distance": 1},
+     "peak_gb": {"segment": 6.0}}
+
+``peak_gb`` is optional and overrides the peaks measured by the work queue.
+"""
+
+import json
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Threads per worker; stages not listed get one thread
+DEFAULT_THREADS = {"segment": 4}
+
+# Share of the physical memory used when no budget is given
+MEMORY_FRACTION = 0.8
+
+# Headroom on top of the measured per-worker peak
+MEMORY_MARGIN = 1.25
+
+# Read by OpenMP (torch, OpenCV builds) and the BLAS libraries when they load
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def total_memory_gb():
+    """Physical memory of this node."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+
+def peak_rss_gb():
+    """Peak resident memory of this process so far, or None where unsupported."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024**3 if sys.platform == "darwin" else 1024**2)
+
+
+def limit_threads(n):
+    """Cap the thread pools of this process (and of processes it starts) at ``n``.
+
+    The environment variables cover libraries loaded after this call; pools that
+    are already running are resized directly.
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n)
+
+    import cv2
+    import tifffile
+
+    cv2.setNumThreads(n)
+    tifffile.TIFF.MAXWORKERS = n
+    tifffile.TIFF.MAXIOWORKERS = n
+
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(n)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        threadpool_limits(n)
+
+
+class ResourceConfig:
+    """Node budget and per-stage thread limits."""
+
+    def __init__(self, cpus=None, memory_gb=None, threads=None, peak_gb=None):
+        self.cpus = cpus or os.cpu_count()
+        self.memory_gb = memory_gb or total_memory_gb() * MEMORY_FRACTION
+        self.threads = {**DEFAULT_THREADS, **(threads or {})}
+        self.peak_gb = dict(peak_gb or {})
+
+    @classmethod
+    def load(cls, path=None, **overrides):
+        """Read a JSON config; keyword arguments that are not None take precedence."""
+        params = {}
+        if path is not None:
+            with open(path) as f:
+                params = json.load(f)
+        params.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(**params)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(vars(self), f, indent=1)
+
+    def stage_threads(self, stage):
+        """Threads of one worker of ``stage``."""
+        return max(1, min(self.threads.get(stage, 1), self.cpus))
+
+    def workers(self, stage, peak_gb):
+        """Concurrent workers of ``stage`` that fit both the CPU and memory budget.
+
+        ``peak_gb`` is the measured peak of one worker; a peak set in the config
+        is used instead.
+        """
+        by_cpu = self.cpus // self.stage_threads(stage)
+        peak_gb = self.peak_gb.get(stage, peak_gb)
+        by_memory = int(self.memory_gb // (peak_gb * MEMORY_MARGIN))
+        return max(1, min(by_cpu, by_memory))
+
+    def __repr__(self):
+        return (
+            f"ResourceConfig(cpus={self.cpus}, memory_gb={self.memory_gb:.1f}, "
+            f"threads={self.threads}, peak_gb={self.peak_gb})"
+        )
@@ -0,0 +1,171 @@
+"""Image sets of an annotation session and their background prefetch.
+
+A session walks through the image-id folders of one group directory.  While
+the current set is annotated, ``Prefetcher`` decodes the next (and optionally
+the previous) set's channels and saved configuration in a worker thread, so
+switching sets only has to hand the arrays to the viewer.  Prefetching is
+skipped when it would exceed the memory budget.
+"""
+
+import pickle as pkl
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import tifffile as tiff
+
+# Upper bound on the decoded channels held by a session (current set included)
+PREFETCH_BYTES = 2 * 1024**3
+
+
+def _natural_key(path):
+    parts = re.split(r"(\d+)", path.name)
+    return [int(s) if s.isdigit() else s.lower() for s in parts]
+
+
+def find_image_sets(group_dir):
+    """Image-id folders of a group that contain TIFF channels, in natural order."""
+    folders = [
+        p for p in Path(group_dir).iterdir() if p.is_dir() and any(p.glob("*.tif"))
+    ]
+    return sorted(folders, key=_natural_key)
+
+
+def channel_names(paths):
+    """Channel names from the filename parts that are not shared by all channels."""
+    temp_split = [p.stem.split("_") for p in paths]
+    common_parts = set(temp_split[0]).intersection(*temp_split)
+    return ["_".join(x for x in parts if x not in common_parts) for parts in temp_split]
+
+
+def estimate_nbytes(paths):
+    """Decoded size of the TIFF channels, read from their headers."""
+    nbytes = 0
+    for path in paths:
+        with tiff.TiffFile(path) as tif:
+            series = tif.series[0]
+            nbytes += int(np.prod(series.shape)) * np.dtype(series.dtype).itemsize
+    return nbytes
+
+
+class ImageSet:
+    """Decoded channels and saved configurations of one image-id folder."""
+
+    def __init__(self, paths, images, configs):
+        self.paths = paths
+        self.images = images
+        self.configs = configs
+        self.channels = channel_names(paths)
+
+        ids = {p.parent.name for p in paths}
+        if len(ids) == 1:
+            self.image_id = ids.pop()
+        else:
+            self.image_id = None
+            print("Error: Image IDs do not match.")
+
+    @property
+    def nbytes(self):
+        return sum(image.nbytes for image in self.images)
+
+    @classmethod
+    def load(cls, paths, load_config=True, callback=None):
+        """Read the channels (transposed for the viewer) and saved configurations."""
+        paths = [Path(p) for p in sorted(map(str, paths), key=str.lower)]
+        images = []
+        for i, path in enumerate(paths, start=1):
+            images.append(np.array(tiff.imread(path)).T)
+            if callback is not None:
+                callback(i)
+
+        configs = []
+        if load_config:
+            for config in paths[0].parent.rglob("*.pickle"):
+                with open(config, "rb") as f:
+                    configs.append(pkl.load(f))
+        return cls(paths, images, configs)
+
+    @classmethod
+    def from_folder(cls, folder):
+        return cls.load(folder.glob("*.tif"))
+
+
+class Prefetcher:
+    """Cache of the current and neighbouring image sets, filled by one worker thread.
+
+    All methods are called from the GUI thread; the worker only decodes files.
+    """
+
+    def __init__(self, folders, max_bytes=PREFETCH_BYTES, previous=False):
+        self.folders = list(folders)
+        self.max_bytes = max_bytes
+        self.previous = previous
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch"
+        )
+        self._cache = {}  # index -> Future of ImageSet
+        self._estimates = {}  # index -> decoded size of a pending prefetch
+
+    def __len__(self):
+        return len(self.folders)
+
+    def get(self, index):
+        """The image set at ``index``, waiting for its prefetch or loading it now."""
+        future = self._cache.get(index)
+        if future is None or future.cancelled():
+            future = Future()
+            try:
+                future.set_result(ImageSet.from_folder(self.folders[index]))
+            except Exception as err:
+                future.set_exception(err)
+            self._cache[index] = future
+        try:
+            return future.result()
+        except Exception:
+            self._cache.pop(index, None)
+            raise
+
+    def prefetch(self, index):
+        """Keep ``index`` and its neighbours cached and start loading missing ones."""
+        wanted = [index + 1] + ([index - 1] if self.previous else [])
+        wanted = [i for i in wanted if 0 <= i < len(self.folders)]
+
+        for i in list(self._cache):
+            if i != index and i not in wanted:
+                self._cache.pop(i).cancel()
+
+        budget = self.max_bytes - self._cached_nbytes(index)
+        for i in wanted:
+            if i in self._cache:
+                nbytes = self._cached_nbytes(i)
+                if nbytes > budget:
+                    self._cache.pop(i).cancel()
+                else:
+                    budget -= nbytes
+                continue
+            try:
+                nbytes = estimate_nbytes(sorted(self.folders[i].glob("*.tif")))
+            except Exception:
+                continue  # broken files are reported when the set is opened
+            if nbytes <= budget:
+                self._cache[i] = self._executor.submit(
+                    ImageSet.from_folder, self.folders[i]
+                )
+                self._estimates[i] = nbytes
+                budget -= nbytes
+
+    def _cached_nbytes(self, index):
+        future = self._cache.get(index)
+        if future is None or future.cancelled():
+            return 0
+        if not future.done():
+            return self._estimates.get(index, 0)
+        return 0 if future.exception() is not None else future.result().nbytes
+
+    def close(self):
+        """Drop the cache and stop the worker after its current set."""
+        for future in self._cache.values():
+            future.cancel()
+        self._cache = {}
+        self._executor.shutdown(wait=False)
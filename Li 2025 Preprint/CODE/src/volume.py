@@ -0,0 +1,388 @@
+"""Distance-binned density and intensity for z-stacks.
+
+The volumetric counterpart of ``combined.py``.  Hole and exclusion outlines
+drawn in the GUI on some slices (``<image_id>/z<k>/z<k>_config.pickle``) are
+interpolated to every slice and stored as 3-D ``hole``/``exclusions``
+datasets in ``<image_id>_mask.h5`` together with the voxel spacing.  The
+anisotropic 3-D distance transform is exact and computed separably: an
+in-plane transform per slice, then a pass along z over slabs of rows, with the
+distances kept in a disk-backed scratch array.  Binning, neuron centroids and
+channel intensities are then processed one slice at a time, so memory stays
+bounded by ``max_bytes`` for stacks that do not fit in RAM.
+
+Results use the same tables as the 2-D analysis; the ``area`` columns hold the
+volume of each distance shell in mm^3 and densities are per mm^3.
+"""
+
+import argparse
+import re
+import tempfile
+from pathlib import Path
+
+import h5py
+import numpy as np
+import tifffile as tiff
+from scipy import ndimage
+
+from distance import result_row, write_group_tables
+from histograms import HIST_SUFFIX, IntensityHistogram, fold, fold_shape, match_id
+from masks import distance_map, label_holes, rasterize, read_config
+from objects import mask_factors
+
+# Upper bound on the working memory of the z pass
+MAX_BYTES = 1024**3
+
+
+def stack_shape(path):
+    """(z, y, x) shape of a TIFF stack, read from its header."""
+    with tiff.TiffFile(path) as tif:
+        return tuple(tif.series[0].shape[-3:])
+
+
+def stack_slices(path):
+    """Yield the slices of a TIFF stack one at a time."""
+    with tiff.TiffFile(path) as tif:
+        for page in tif.series[0].pages:
+            yield page.asarray()
+
+
+def find_slice_configs(second_img_dir):
+    """Map slice index -> GUI configuration for the ``z<k>`` subfolders of an image."""
+    configs = {}
+    for config in Path(second_img_dir).glob("z*/*_config.pickle"):
+        match = re.fullmatch(r"z(\d+)", config.parent.name)
+        if match:
+            configs[int(match.group(1))] = config
+    return dict(sorted(configs.items()))
+
+
+def _signed_distance(mask):
+    """In-plane signed distance in pixels, negative inside the mask."""
+    if not mask.any():
+        return np.full(mask.shape, float(max(mask.shape)), dtype=np.float32)
+    return distance_map(mask) - distance_map(~mask)
+
+
+def interpolate_masks(key_masks, n_slices):
+    """Yield the mask of every slice from masks drawn on some of them.
+
+    Between two annotated slices the shape is interpolated through linearly
+    blended signed distance maps; slices before the first or after the last
+    annotated slice copy the nearest one.  Only the signed distances of the two
+    annotated slices around the current one are kept.
+    """
+    keys = sorted(key_masks)
+    signed = {}
+    for z in range(n_slices):
+        if z in key_masks or z < keys[0] or z > keys[-1]:
+            yield key_masks[min(max(z, keys[0]), keys[-1])]
+            continue
+        z0 = max(k for k in keys if k < z)
+        z1 = min(k for k in keys if k > z)
+        signed = {k: signed.get(k) for k in (z0, z1)}
+        for k in (z0, z1):
+            if signed[k] is None:
+                signed[k] = _signed_distance(key_masks[k])
+        t = (z - z0) / (z1 - z0)
+        yield (1 - t) * signed[z0] + t * signed[z1] <= 0
+
+
+def write_volume_mask(second_img_dir, h5_path, shape, spacing):
+    """Rasterize and interpolate the per-slice outlines into a 3-D ``_mask.h5``.
+
+    Slices are interpolated and written one at a time into chunked datasets.
+    """
+    configs = find_slice_configs(second_img_dir)
+    if not configs:
+        raise FileNotFoundError(f"No z<k>/*_config.pickle in {second_img_dir}")
+    n_slices, ny, nx = shape
+
+    holes, exclusions = {}, {}
+    for z, config in configs.items():
+        hole_polys, excl_polys = read_config(config)
+        holes[z] = label_holes(hole_polys, (ny, nx)) > 0
+        exclusions[z] = np.zeros((ny, nx), dtype=bool)
+        for vertices in excl_polys:
+            exclusions[z] |= rasterize(vertices, (ny, nx))
+
+    with h5py.File(h5_path, "w") as hf:
+        hf.attrs["spacing_um"] = spacing
+        for name, masks in (("hole", holes), ("exclusions", exclusions)):
+            dataset = hf.create_dataset(
+                name,
+                shape=shape,
+                dtype=bool,
+                chunks=(1, ny, nx),
+                compression="gzip",
+            )
+            for z, mask in enumerate(interpolate_masks(masks, n_slices)):
+                dataset[z] = mask
+
+
+def planar_sq_distance(hole_slice, dy, dx):
+    """Squared in-plane distance (um^2) to the hole; infinite if the slice has none."""
+    if not hole_slice.any():
+        return np.full(hole_slice.shape, np.inf, dtype=np.float32)
+    if dy == dx:
+        dist = distance_map(hole_slice) * dx
+    else:
+        dist = ndimage.distance_transform_edt(~hole_slice, sampling=(dy, dx))
+    return (dist**2).astype(np.float32)
+
+
+def _lower_envelope(f, dz):
+    """Squared distances along axis 0 given squared distances ``f`` in each slice.
+
+    The lower envelope of the parabolas ``f[r] + ((q - r) * dz)^2`` is built per
+    column (Felzenszwalb and Huttenlocher), stepping all columns of ``f`` (z, n)
+    together; slices where ``f`` is infinite add no parabola.
+    """
+    n_slices, n = f.shape
+    cols = np.arange(n)
+    z = np.arange(n_slices) * float(dz)
+    # parabola vertices of each envelope and the z where each one takes over
+    v = np.zeros((n_slices, n), dtype=np.int32)
+    start = np.full((n_slices + 1, n), np.inf)
+    k = np.full(n, -1)
+    for q in range(n_slices):
+        new = np.flatnonzero(np.isfinite(f[q]))
+        s = np.full(n, -np.inf)
+        pending = new[k[new] >= 0]
+        while pending.size:
+            r = v[k[pending], pending]
+            s[pending] = (f[q, pending] + z[q] ** 2 - f[r, pending] - z[r] ** 2) / (
+                2 * (z[q] - z[r])
+            )
+            hidden = s[pending] <= start[k[pending], pending]
+            pending = pending[hidden]
+            k[pending] -= 1
+        k[new] += 1
+        v[k[new], new] = q
+        start[k[new], new] = s[new]
+        start[k[new] + 1, new] = np.inf
+
+    dist = np.empty_like(f)
+    k = np.zeros(n, dtype=np.intp)
+    for q in range(n_slices):
+        while True:
+            later = start[k + 1, cols] < z[q]
+            if not later.any():
+                break
+            k[later] += 1
+        r = v[k, cols]
+        dist[q] = f[r, cols] + (z[q] - z[r]) ** 2
+    return dist
+
+
+def distance_volume(hole, spacing, out, max_bytes=MAX_BYTES):
+    """Exact anisotropic distance (um) from every voxel to the hole, written to ``out``.
+
+    ``hole`` is a (z, y, x) boolean array or HDF5 dataset and ``out`` a float32
+    array of the same shape (e.g. a memmap).  The z pass runs on slabs of rows
+    sized to fit ``max_bytes`` and takes the lower envelope of the planar
+    squared distances along z, which is linear in the number of slices.
+    Returns the largest finite distance.
+    """
+    dz, dy, dx = spacing
+    n_slices, ny, nx = hole.shape
+    for z in range(n_slices):
+        out[z] = planar_sq_distance(np.asarray(hole[z]), dy, dx)
+
+    max_dist = 0.0
+    rows = max(1, int(max_bytes // (24 * n_slices * nx)))
+    for y0 in range(0, ny, rows):
+        planar = np.array(out[:, y0 : y0 + rows])
+        dist = _lower_envelope(planar.reshape(n_slices, -1), dz)
+        dist = np.sqrt(dist).reshape(planar.shape)
+        out[:, y0 : y0 + rows] = dist
+        finite = dist[np.isfinite(dist)]
+        if finite.size:
+            max_dist = max(max_dist, float(finite.max()))
+    return max_dist
+
+
+def stack_centroids(mask_path):
+    """(x, y, z) centroids of the labels of a 3-D Cellpose mask, read slice by slice."""
+    area = np.zeros(0)
+    sums = np.zeros((3, 0))
+    for z, labels in enumerate(stack_slices(mask_path)):
+        ny, nx = labels.shape
+        labels = labels.ravel()
+        n = max(len(area), int(labels.max()) + 1)
+        area = np.pad(area, (0, n - len(area)))
+        sums = np.pad(sums, ((0, 0), (0, n - sums.shape[1])))
+
+        slice_area = np.bincount(labels, minlength=n)
+        area += slice_area
+        sums[0] += np.bincount(
+            labels, weights=np.tile(np.arange(nx), ny), minlength=n
+        )
+        sums[1] += np.bincount(
+            labels, weights=np.repeat(np.arange(ny), nx), minlength=n
+        )
+        sums[2] += slice_area * z
+
+    ids = np.flatnonzero(area[1:]) + 1
+    return (sums[:, ids] / area[ids]).T
+
+
+def _step_sums(index, n_steps, weights=None):
+    """Per-step totals; index ``n_steps`` marks voxels without a hole in any slice."""
+    return np.bincount(index, weights=weights, minlength=n_steps + 1)[:n_steps]
+
+
+def analyze_stack(
+    mask_path,
+    second_img_dir,
+    bins,
+    comp_fct,
+    channels=(),
+    step=5,
+    max_bytes=MAX_BYTES,
+    scratch_dir=None,
+):
+    """Density (per mm^3), count and volume (mm^3) per bin, spacing and histogram.
+
+    ``mask_path`` is the 3-D Cellpose label stack (in-plane compressed by its
+    recorded scale, else by ``comp_fct``; full z resolution) and
+    ``second_img_dir`` holds the 3-D ``_mask.h5`` and the channel stacks.  The
+    voxel spacing (um) comes from the mask; without ``channels`` the histogram
+    is ``None``.
+    """
+    second_img_dir = Path(second_img_dir)
+    second_mask_path = next(second_img_dir.glob("*_mask.h5"))
+    factor, n_bins = fold_shape(step, bins[1] - bins[0], bins[-1])
+
+    _, comp_fct = mask_factors(mask_path, None, comp_fct)
+    centroids = stack_centroids(mask_path)
+    centroids[:, :2] /= comp_fct
+    cz = centroids[:, 2].astype(int)
+
+    channel_paths = []
+    for channel in channels:
+        path = match_id(channel, ".tif", second_img_dir)
+        if path is None:
+            raise FileNotFoundError(f"No {channel} TIFF in {second_img_dir}")
+        channel_paths.append(path)
+
+    hf = h5py.File(second_mask_path, "r")
+    tmp = tempfile.TemporaryDirectory(dir=scratch_dir)
+    with hf, tmp:
+        hole, exclusions = hf["hole"], hf["exclusions"]
+        spacing = tuple(hf.attrs["spacing_um"])
+        dist = np.lib.format.open_memmap(
+            Path(tmp.name) / "distance.npy",
+            mode="w+",
+            dtype=np.float32,
+            shape=hole.shape,
+        )
+        max_dist = distance_volume(hole, spacing, dist, max_bytes=max_bytes)
+        n_steps = int(max_dist // step) + 1
+
+        volume_steps = np.zeros(n_steps)
+        count_steps = np.zeros(n_steps)
+        hist = IntensityHistogram(step, np.zeros(n_steps, dtype=np.int64))
+        for channel in channels:
+            hist.sums[channel] = np.zeros(n_steps)
+            hist.sumsq[channel] = np.zeros(n_steps)
+        readers = [stack_slices(path) for path in channel_paths]
+
+        for z in range(hole.shape[0]):
+            hole_z = hole[z]
+            excluded = hole_z | exclusions[z]
+            dist_z = dist[z]
+            steps = np.full(dist_z.shape, n_steps, dtype=np.intp)
+            ok = np.isfinite(dist_z)
+            steps[ok] = (dist_z[ok] // step).astype(np.intp)
+
+            # volume of everything but the hole, neurons outside hole/exclusions
+            volume_steps += _step_sums(steps[~hole_z], n_steps)
+            in_slice = cz == z
+            x = centroids[in_slice, 0].astype(int)
+            y = centroids[in_slice, 1].astype(int)
+            keep = ~excluded[y, x]
+            count_steps += _step_sums(steps[y[keep], x[keep]], n_steps)
+
+            # intensity: voxels outside the hole/exclusions, same step indices
+            index = steps[~excluded]
+            hist.count += _step_sums(index, n_steps).astype(np.int64)
+            for channel, reader in zip(channels, readers):
+                values = next(reader)[~excluded].astype(np.float64)
+                hist.sums[channel] += _step_sums(index, n_steps, values)
+                hist.sumsq[channel] += _step_sums(index, n_steps, values**2)
+        del dist
+
+    voxel_volume = spacing[0] * spacing[1] * spacing[2]
+    count = fold(count_steps, factor, n_bins)
+    volume = fold(volume_steps, factor, n_bins) * voxel_volume
+    with np.errstate(invalid="ignore", divide="ignore"):
+        density = count / volume * 1e9  # convert to mm^3
+    volume = volume / 1e9  # convert to mm^3
+
+    if not channels:
+        hist = None
+    return density, count, volume, spacing, hist
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Volumetric distance analysis.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    mask = sub.add_parser("mask", help="interpolate per-slice outlines into _mask.h5")
+    mask.add_argument("second_img_dir", type=Path)
+    mask.add_argument(
+        "--spacing", type=float, nargs=3, required=True, metavar=("DZ", "DY", "DX")
+    )
+
+    run = sub.add_parser("analyze", help="density/intensity tables for all stacks")
+    run.add_argument("--output", type=Path, default=Path("../output"))
+    run.add_argument("--second", type=Path, default=Path("../masks_SECOND"))
+    run.add_argument("--results", type=Path, default=Path("../results"))
+    run.add_argument("--bin", type=int, default=50, help="bin width (um)")
+    run.add_argument("--up-lim", type=int, default=1000, help="upper limit (um)")
+    run.add_argument("--comp", type=float, default=0.5, help="compression factor")
+    run.add_argument("--channels", default="", help="e.g. AF488,AF594")
+    run.add_argument("--step", type=int, default=5, help="step size (um)")
+    run.add_argument("--max-mem", type=float, default=1.0, help="GiB for the z pass")
+    args = parser.parse_args()
+
+    if args.command == "mask":
+        image_id = args.second_img_dir.name
+        stack = next(p for p in args.second_img_dir.glob("*.tif"))
+        h5_path = args.second_img_dir / f"{image_id}_mask.h5"
+        write_volume_mask(
+            args.second_img_dir, h5_path, stack_shape(stack), tuple(args.spacing)
+        )
+        print(f"Wrote {h5_path}")
+        return
+
+    channels = [ch for ch in args.channels.replace(" ", "").split(",") if ch]
+    bins = np.arange(0, args.up_lim + args.bin, args.bin)
+    for group in sorted(g for g in args.output.iterdir() if g.is_dir()):
+        rows = {"density": [], "count": [], "area": []}
+        for mask_path in sorted(group.rglob("*_masks.tif")):
+            img_id = mask_path.stem.replace("_masks", "")
+            second_img_dir = args.second / group.name / img_id
+            density, count, volume, spacing, hist = analyze_stack(
+                mask_path,
+                second_img_dir,
+                bins,
+                args.comp,
+                channels=channels,
+                step=args.step,
+                max_bytes=args.max_mem * 1024**3,
+            )
+            for name, values in zip(rows, (density, count, volume)):
+                rows[name].append(result_row(img_id, values, bins))
+            if hist is not None:
+                hist.save(
+                    second_img_dir / f"{img_id}{HIST_SUFFIX}", spacing_um=spacing
+                )
+        write_group_tables(
+            args.results, group.name, rows["density"], rows["count"], rows["area"]
+        )
+        print(f"{group.name}: {len(rows['density'])} stacks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Cached access to the study workbooks under ``DATA/``.
+
+Every sheet is parsed once into a typed table and stored as Parquet in a cache
+folder keyed by the SHA-256 of the workbook, so later runs skip openpyxl
+entirely; caches written by another ``PARSER_VERSION`` are parsed again.
+``StudyData.query`` returns tidy rows (dataset, sheet, row, id columns,
+variable, value) across all workbooks.
+
+New workbooks are parsed in worker processes where Python forks them.  With the
+spawn start method (Windows, macOS) the workers re-import the calling script,
+so they are only used when ``workers`` is given, and the script must then guard
+its code with ``if __name__ == "__main__":``.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import re
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+import pandas as pd
+
+# Li 2025 Preprint/DATA, next to the CODE folder
+DATA_ROOT = Path(__file__).resolve().parents[2] / "DATA"
+CACHE_NAME = ".cache"
+
+# cell markers such as "*", "-" or "N/A" that stand for a missing number
+MISSING = re.compile(r"^\W*$|^n/?a$", re.IGNORECASE)
+
+# Bump when clean_sheet or MISSING change, so cached tables are parsed again
+PARSER_VERSION = 1
+
+
+def workbook_hash(path):
+    """SHA-256 of the workbook bytes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def clean_sheet(frame):
+    """Drop empty rows/columns, tidy header names and give each column one type."""
+    frame = frame.dropna(how="all").dropna(axis=1, how="all")
+    frame.columns = [str(c).replace("\xa0", " ").strip() for c in frame.columns]
+
+    for col in frame.columns[frame.dtypes == object]:
+        values = frame[col].dropna()
+        if values.map(lambda v: isinstance(v, str)).all():
+            continue
+        numeric = pd.to_numeric(values, errors="coerce")
+        markers = values[numeric.isna()].astype(str).str.strip()
+        if numeric.notna().any() and markers.map(MISSING.match).notna().all():
+            frame[col] = pd.to_numeric(frame[col], errors="coerce")
+        else:
+            frame[col] = frame[col].map(lambda v: v if pd.isna(v) else str(v))
+    return frame.reset_index(drop=True)
+
+
+def read_workbook(path):
+    """Parse every sheet of a workbook into cleaned tables (the slow openpyxl pass)."""
+    sheets = pd.read_excel(path, sheet_name=None, engine="openpyxl")
+    return {name.strip(): clean_sheet(frame) for name, frame in sheets.items()}
+
+
+def tidy(frame):
+    """Long form of a sheet: text/date columns are kept as ids, numeric ones melted."""
+    numeric = pd.api.types.is_numeric_dtype
+    value_vars = [c for c in frame.columns if numeric(frame[c])]
+    id_vars = [c for c in frame.columns if c not in value_vars]
+    long = frame.melt(id_vars=id_vars, value_vars=value_vars, ignore_index=False)
+    long = long.dropna(subset=["value"]).rename_axis("row").reset_index()
+    return long[["row", *id_vars, "variable", "value"]]
+
+
+def is_cached(folder):
+    """Whether a cache folder is complete and was written by the current parser."""
+    index = Path(folder) / "sheets.json"
+    if not index.exists():
+        return False
+    with open(index) as f:
+        return json.load(f).get("parser_version") == PARSER_VERSION
+
+
+def cache_workbook(path, folder):
+    """Parse a workbook into its cache folder (``<cache_dir>/<hash>``)."""
+    folder = Path(folder)
+    sheets = read_workbook(path)
+    folder.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for i, (name, frame) in enumerate(sheets.items()):
+        files[name] = f"{i}.parquet"
+        frame.to_parquet(folder / files[name], index=False)
+
+    # written last so a partially written folder is parsed again
+    with open(folder / "sheets.json", "w") as f:
+        json.dump(
+            {
+                "workbook": Path(path).name,
+                "parser_version": PARSER_VERSION,
+                "sheets": files,
+            },
+            f,
+            indent=1,
+        )
+    return folder
+
+
+def load_cached(folder):
+    """Read the sheets of a cached workbook."""
+    with open(Path(folder) / "sheets.json") as f:
+        files = json.load(f)["sheets"]
+    return {
+        name: pd.read_parquet(Path(folder) / file) for name, file in files.items()
+    }
+
+
+def _run_now(fn, *args):
+    """Run ``fn`` in this process and return its outcome as a finished Future."""
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as err:
+        future.set_exception(err)
+    return future
+
+
+def _matches(value, pattern):
+    if pattern is None:
+        return True
+    if isinstance(pattern, str):
+        return fnmatchcase(value, pattern)
+    return value in pattern
+
+
+class StudyData:
+    """All workbooks below one or more ``DATA`` folders, parsed once and cached.
+
+    Datasets are named by their path below the root without the suffix, e.g.
+    ``Electrophysiology/Fig2``.  Workbooks that cannot be read (such as empty
+    placeholders) are reported and skipped.  ``workers`` processes parse new
+    workbooks; ``None`` means one per core, or parsing in this process where
+    workers would be spawned (see the module docstring).
+    """
+
+    def __init__(self, roots=(DATA_ROOT,), cache_dir=None, workers=None):
+        self.roots = [Path(root) for root in roots]
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.workers = workers
+        self.tables = {}  # (dataset, sheet) -> DataFrame
+
+        self.workbooks = {}
+        for root in self.roots:
+            for path in sorted(root.rglob("*.xlsx")):
+                if not path.name.startswith("~$") and CACHE_NAME not in path.parts:
+                    dataset = path.relative_to(root).with_suffix("").as_posix()
+                    self.workbooks[dataset] = path
+
+    def cache_folder(self, path):
+        """Cache folder of a workbook, named after its hash."""
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            cache_dir = next(r for r in self.roots if r in path.parents) / CACHE_NAME
+        return cache_dir / workbook_hash(path)
+
+    def load(self):
+        """Parse new or changed workbooks in parallel, then read every sheet cached."""
+        folders = {}
+        for dataset, path in self.workbooks.items():
+            if path.stat().st_size == 0:
+                print(f"{dataset}: empty workbook, skipped")
+            else:
+                folders[dataset] = self.cache_folder(path)
+
+        missing = [ds for ds, folder in folders.items() if not is_cached(folder)]
+        in_process = (
+            self.workers == 1
+            or len(missing) < 2
+            or (self.workers is None and mp.get_start_method() != "fork")
+        )
+        if missing:
+            pool = None if in_process else ProcessPoolExecutor(self.workers)
+            submit = _run_now if pool is None else pool.submit
+            futures = {
+                dataset: submit(
+                    cache_workbook, self.workbooks[dataset], folders[dataset]
+                )
+                for dataset in missing
+            }
+            for dataset, future in futures.items():
+                try:
+                    future.result()
+                except Exception as err:
+                    print(f"{dataset}: could not be read ({err})")
+                    folders.pop(dataset)
+            if pool is not None:
+                pool.shutdown()
+
+        for dataset, folder in folders.items():
+            for sheet, frame in load_cached(folder).items():
+                self.tables[dataset, sheet] = frame
+        return self
+
+    def sheets(self, dataset=None):
+        """(dataset, sheet) pairs, optionally filtered by a dataset pattern."""
+        return [key for key in self.tables if _matches(key[0], dataset)]
+
+    def table(self, dataset, sheet):
+        """The typed wide table of one sheet as it appears in the workbook."""
+        return self.tables[dataset, sheet]
+
+    def query(self, dataset=None, sheet=None, variable=None, **filters):
+        """Tidy rows across workbooks.
+
+        ``dataset``, ``sheet`` and ``variable`` take a glob pattern (``"Fig4*"``) or
+        a list of names; other keywords filter id columns by value or list of
+        values, e.g. ``query("Weight_Blood/*", Treatment="PIN")``.
+        """
+        parts = []
+        for (ds, sh), frame in self.tables.items():
+            if not (_matches(ds, dataset) and _matches(sh, sheet)):
+                continue
+            if any(col not in frame.columns for col in filters):
+                continue
+            long = tidy(frame)
+            if variable is not None:
+                long = long[long["variable"].map(lambda v: _matches(v, variable))]
+            for col, value in filters.items():
+                values = value if isinstance(value, (list, tuple, set)) else [value]
+                long = long[long[col].isin(values)]
+            parts.append(long.assign(dataset=ds, sheet=sh))
+
+        columns = ["dataset", "sheet", "row", "variable", "value"]
+        if not parts:
+            return pd.DataFrame(columns=columns)
+        result = pd.concat(parts, ignore_index=True)
+        # id columns of sheets that were filtered out entirely
+        result = result.dropna(axis=1, how="all")
+        ids = [c for c in result.columns if c not in columns]
+        return result[[*columns[:3], *ids, *columns[3:]]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse and cache the workbooks.")
+    parser.add_argument("roots", nargs="*", type=Path, default=[DATA_ROOT])
+    parser.add_argument("--cache-dir", type=Path)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    # guarded by __main__, so worker processes are safe with any start method
+    workers = args.workers or os.cpu_count()
+    data = StudyData(args.roots, cache_dir=args.cache_dir, workers=workers).load()
+    elapsed = time.perf_counter() - start
+
+    for dataset, sheet in data.sheets():
+        rows, cols = data.table(dataset, sheet).shape
+        print(f"{dataset} | {sheet}: {rows} rows x {cols} columns")
+    print(f"Loaded {len(data.tables)} sheets in {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
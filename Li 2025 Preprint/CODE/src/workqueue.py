@@ -0,0 +1,813 @@
+"""Filesystem-backed work queue for running the pipeline on several machines.
+
+Tasks live in a single SQLite database on the shared filesystem; there is no
+broker.  Each task is one image of one stage (``segment``, ``rasterize``,
+``distance``, ``intensity`` or ``analyze``, which computes density and intensity
+in one pass) and is enumerated from the same directory layout
+the notebooks and the GUI use.  Workers claim tasks under a lease that a
+background thread renews while the task runs, so tasks of crashed workers are
+picked up again once their lease expires.  Failed tasks are retried up to
+``max_attempts`` times.
+
+``run`` schedules the queued stages one after another under the CPU and memory
+budget of ``resources.py``: every worker's torch/OpenCV/BLAS thread pools are
+capped at the stage's thread count, the peak memory of each finished task is
+recorded, and a stage runs as many workers as fit the budget for that peak
+(after measuring it on a single task when the stage has no record yet).
+
+Typical use (from ``CODE/src``)::
+
+    python workqueue.py queue.db enqueue segment --data ../data --output ../output \\
+        --model ../models/Chronic_LSL_NeuN_Final
+    python workqueue.py queue.db work            # on every node, as often as wanted
+    python workqueue.py queue.db run             # or local workers sized to the node
+    python workqueue.py queue.db run --resources ../resources.json
+    python workqueue.py queue.db status
+    python workqueue.py queue.db collect --results ../results
+
+The database uses SQLite's default rollback journal (WAL does not work on
+network filesystems) and ``BEGIN IMMEDIATE`` transactions for claiming.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from resources import ResourceConfig, limit_threads, peak_rss_gb
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    lease_until REAL,
+    available_at REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    peak_gb REAL,
+    UNIQUE (stage, key)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, stage);
+"""
+
+
+def worker_id():
+    """Identifier of the current process, unique across nodes."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """SQLite task table with leased claims and retries."""
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = str(db_path)
+        self.timeout = timeout
+        self.conn = self._connect()
+        self.conn.executescript(SCHEMA)
+        columns = {r["name"] for r in self.conn.execute("PRAGMA table_info(tasks)")}
+        if "peak_gb" not in columns:  # queues created before peaks were recorded
+            self.conn.execute("ALTER TABLE tasks ADD COLUMN peak_gb REAL")
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path, timeout=self.timeout, isolation_level=None
+        )
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, stage, key, payload, max_attempts=3):
+        """Add a task; tasks already in the queue (same stage and key) are kept as is."""
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO tasks (stage, key, payload, max_attempts, created) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (stage, key, json.dumps(payload), max_attempts, time.time()),
+        )
+        return cur.rowcount
+
+    def claim(self, worker, stages=None, lease=600):
+        """Claim the next available task, or return None when there is nothing to do."""
+        now = time.time()
+        stage_sql = ""
+        params = [now, now]
+        if stages:
+            stage_sql = f"AND stage IN ({','.join('?' * len(stages))})"
+            params.extend(stages)
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # tasks whose worker died on their last attempt will not be retried
+            self.conn.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired' "
+                "WHERE status = 'running' AND lease_until < ? "
+                "AND attempts >= max_attempts",
+                (now,),
+            )
+            row = self.conn.execute(
+                "SELECT * FROM tasks WHERE attempts < max_attempts AND ("
+                "(status = 'pending' AND available_at <= ?) "
+                "OR (status = 'running' AND lease_until < ?)) "
+                f"{stage_sql} ORDER BY id LIMIT 1",
+                params,
+            ).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+            self.conn.execute(
+                "UPDATE tasks SET status = 'running', attempts = attempts + 1, "
+                "worker = ?, lease_until = ?, started = ? WHERE id = ?",
+                (worker, now + lease, now, row["id"]),
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        task = dict(row)
+        task.update(status="running", attempts=row["attempts"] + 1, worker=worker)
+        task["payload"] = json.loads(task["payload"])
+        return task
+
+    def renew(self, task_id, worker, lease=600, conn=None):
+        """Extend the lease of a running task; returns False if the task was lost."""
+        cur = (conn or self.conn).execute(
+            "UPDATE tasks SET lease_until = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time() + lease, task_id, worker),
+        )
+        return cur.rowcount == 1
+
+    def complete(self, task_id, worker, peak_gb=None):
+        """Mark a task as done, with the peak memory of its worker so far."""
+        self.conn.execute(
+            "UPDATE tasks SET status = 'done', finished = ?, error = NULL, "
+            "peak_gb = ? WHERE id = ? AND worker = ?",
+            (time.time(), peak_gb, task_id, worker),
+        )
+
+    def fail(self, task_id, worker, error, retry_delay=30):
+        """Record a failure; the task is retried after a delay until attempts run out."""
+        now = time.time()
+        self.conn.execute(
+            "UPDATE tasks SET "
+            "status = CASE WHEN attempts < max_attempts "
+            "THEN 'pending' ELSE 'failed' END, "
+            "available_at = ? + ? * attempts, finished = ?, error = ? "
+            "WHERE id = ? AND worker = ?",
+            (now, retry_delay, now, error, task_id, worker),
+        )
+
+    def next_retry(self, stages=None):
+        """Time the next pending task becomes available, or None if none is pending."""
+        sql = (
+            "SELECT MIN(available_at) FROM tasks "
+            "WHERE status = 'pending' AND attempts < max_attempts"
+        )
+        params = []
+        if stages:
+            sql += f" AND stage IN ({','.join('?' * len(stages))})"
+            params.extend(stages)
+        return self.conn.execute(sql, params).fetchone()[0]
+
+    def remaining(self, stage):
+        """Number of tasks of a stage that are pending or running."""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE stage = ? "
+            "AND status IN ('pending', 'running')",
+            (stage,),
+        ).fetchone()[0]
+
+    def failed(self, stage):
+        """Number of tasks of a stage that failed on every attempt."""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE stage = ? AND status = 'failed'",
+            (stage,),
+        ).fetchone()[0]
+
+    def peak_gb(self, stage):
+        """Largest worker peak memory recorded for a stage, or None."""
+        return self.conn.execute(
+            "SELECT MAX(peak_gb) FROM tasks WHERE stage = ? AND status = 'done'",
+            (stage,),
+        ).fetchone()[0]
+
+    def retry_failed(self, stage=None):
+        """Reset failed tasks so they get another ``max_attempts`` tries."""
+        sql = "UPDATE tasks SET status = 'pending', attempts = 0, available_at = 0 "
+        sql += "WHERE status = 'failed'"
+        params = []
+        if stage:
+            sql += " AND stage = ?"
+            params.append(stage)
+        return self.conn.execute(sql, params).rowcount
+
+    def status(self, window=600):
+        """Task counts per stage and status, and recent throughput per stage and worker."""
+        counts = self.conn.execute(
+            "SELECT stage, status, COUNT(*) AS n FROM tasks GROUP BY stage, status"
+        ).fetchall()
+        since = time.time() - window
+        recent = self.conn.execute(
+            "SELECT stage, worker, COUNT(*) AS n, AVG(finished - started) AS mean_s, "
+            "MAX(finished) - MIN(started) AS span_s, MAX(peak_gb) AS peak_gb "
+            "FROM tasks WHERE status = 'done' AND finished >= ? "
+            "GROUP BY stage, worker",
+            (since,),
+        ).fetchall()
+        failed = self.conn.execute(
+            "SELECT stage, key, error FROM tasks WHERE status = 'failed'"
+        ).fetchall()
+        return [dict(r) for r in counts], [dict(r) for r in recent], failed
+
+
+class _LeaseKeeper(threading.Thread):
+    """Renews the lease of the running task until stopped."""
+
+    def __init__(self, queue, task_id, worker, lease):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.task_id = task_id
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def run(self):
+        # sqlite connections cannot be shared between threads
+        conn = self.queue._connect()
+        while not self.stopped.wait(self.lease / 3):
+            if not self.queue.renew(self.task_id, self.worker, self.lease, conn=conn):
+                print(f"{self.worker}: lost lease on task {self.task_id}")
+                break
+        conn.close()
+
+
+# Stage handlers: each takes the task payload and writes its outputs to disk.
+# Heavy dependencies are imported lazily so a node only needs what it runs.
+
+_model_cache = {}
+
+
+def run_segment(payload):
+    """Cellpose prediction for one image, writing the mask and object table."""
+    from cellpose import io
+
+    from inference import downsample, load_model
+    from objects import OBJECTS_SUFFIX, write_masks, write_object_table
+
+    key = (payload["model"], payload["precision"], payload["graph"])
+    if key not in _model_cache:
+        _model_cache[key] = load_model(
+            payload["model"],
+            gpu=payload["gpu"],
+            precision=payload["precision"],
+            graph=payload["graph"],
+            threads=payload["threads"],
+        )
+    model = _model_cache[key]
+
+    img_path = Path(payload["image"])
+    mask_dir = Path(payload["mask_dir"])
+    mask_dir.mkdir(parents=True, exist_ok=True)
+
+    inference_scale = payload.get("inference_scale", 1)
+    img = downsample(io.imread(img_path), inference_scale)
+    masks, _, _ = model.eval(
+        img,
+        diameter=model.diam_labels * inference_scale,
+        channels=payload["channels"],
+    )
+    # mask pixels per SECOND-image pixel
+    scale = payload.get("image_scale", 0.5) * inference_scale
+    write_masks(
+        str(mask_dir / img_path.stem) + "_masks.tif",
+        masks,
+        scale=scale,
+        pixel_size_um=payload.get("pixel_um", 0.344) / scale,
+    )
+    write_object_table(masks, mask_dir / f"{img_path.stem}{OBJECTS_SUFFIX}")
+
+
+def run_rasterize(payload):
+    """Rasterize a GUI configuration into ``_mask.h5``."""
+    from masks import write_h5_mask
+
+    write_h5_mask(payload["config"], payload["h5"], tuple(payload["shape"]))
+
+
+def run_distance(payload):
+    """Distance-binned density for one image, written as a per-image CSV."""
+    import numpy as np
+    import pandas as pd
+
+    from distance import analyze_image, bin_labels
+
+    bins = np.arange(0, payload["up_lim"] + payload["bin"], payload["bin"])
+    density, count, area = analyze_image(
+        Path(payload["mask"]),
+        Path(payload["second_dir"]),
+        bins,
+        payload["conv_fct"],
+        payload["comp_fct"],
+        distance_mode=payload["mode"],
+    )
+    out = Path(payload["out"])
+    out.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(
+        {"bin": bin_labels(bins), "density": density, "count": count, "area": area}
+    ).to_csv(out, index=False)
+
+
+def run_intensity(payload):
+    """Fine-step intensity histogram for one image."""
+    from histograms import HIST_SUFFIX, image_histogram, unpack_h5
+
+    mask_path = Path(payload["mask"])
+    map_hole, mask_all = unpack_h5(mask_path)
+    hist = image_histogram(
+        map_hole,
+        mask_all,
+        payload["channels"],
+        payload["channel_files"],
+        payload["step"],
+        payload["conv_fct"],
+    )
+    hist.save(
+        mask_path.parent / f"{payload['image_id']}{HIST_SUFFIX}",
+        conv_fct=payload["conv_fct"],
+    )
+
+
+def run_analyze(payload):
+    """Density and intensity of one image from one mask read and distance map."""
+    import numpy as np
+    import pandas as pd
+
+    from combined import analyze_image
+    from distance import bin_labels
+    from histograms import HIST_SUFFIX
+
+    second_dir = Path(payload["second_dir"])
+    bins = np.arange(0, payload["up_lim"] + payload["bin"], payload["bin"])
+    density, count, area, hist = analyze_image(
+        Path(payload["mask"]),
+        second_dir,
+        bins,
+        payload["conv_fct"],
+        payload["comp_fct"],
+        channels=payload["channels"],
+        step=payload["step"],
+    )
+    out = Path(payload["out"])
+    out.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(
+        {"bin": bin_labels(bins), "density": density, "count": count, "area": area}
+    ).to_csv(out, index=False)
+    if hist is not None:
+        hist.save(
+            second_dir / f"{second_dir.name}{HIST_SUFFIX}",
+            conv_fct=payload["conv_fct"],
+        )
+
+
+HANDLERS = {
+    "segment": run_segment,
+    "rasterize": run_rasterize,
+    "distance": run_distance,
+    "intensity": run_intensity,
+    "analyze": run_analyze,
+}
+
+# Order in which ``run`` schedules the stages (later stages read earlier outputs)
+STAGES = ("segment", "rasterize", "distance", "analyze", "intensity")
+
+
+# Task enumeration from the data layout
+
+
+def segment_tasks(
+    data_dir,
+    output_dir,
+    model,
+    gpu,
+    precision,
+    graph,
+    threads,
+    inference_scale=1,
+    image_scale=0.5,
+    pixel_um=0.344,
+):
+    """``data/<group>/*.png`` -> ``output/<group>/mask/<image>_masks.tif``.
+
+    ``image_scale`` is PNG pixels per SECOND-image pixel and ``pixel_um`` the
+    SECOND pixel size; with the ``inference_scale`` they are recorded in the mask.
+    """
+    for folder in sorted(f for f in Path(data_dir).iterdir() if f.is_dir()):
+        for img_path in sorted(folder.glob("*.png")):
+            yield f"{folder.name}/{img_path.stem}", {
+                "image": str(img_path),
+                "mask_dir": str(Path(output_dir) / folder.name / "mask"),
+                "model": str(model),
+                "gpu": gpu,
+                "precision": precision,
+                "graph": graph,
+                "threads": threads,
+                "channels": [2, 0],
+                "inference_scale": inference_scale,
+                "image_scale": image_scale,
+                "pixel_um": pixel_um,
+            }
+
+
+def rasterize_tasks(second_dir):
+    """``<image_id>_config.pickle`` -> ``<image_id>_mask.h5``, sized like the TIFFs."""
+    import tifffile as tiff
+
+    for config in sorted(Path(second_dir).rglob("*_config.pickle")):
+        image_id = config.parent.name
+        tiffs = sorted(config.parent.glob("*.tif"))
+        if not tiffs:
+            print(f"Skipping {config}: no TIFF to take the image size from")
+            continue
+        with tiff.TiffFile(tiffs[0]) as tf:
+            shape = tf.pages[0].shape[:2]
+        yield str(config.parent.relative_to(second_dir)), {
+            "config": str(config),
+            "h5": str(config.parent / f"{image_id}_mask.h5"),
+            "shape": list(shape),
+        }
+
+
+def distance_tasks(output_dir, second_dir, results_dir, params):
+    """One task per ``output/<group>/**/<image>_masks.tif`` with a SECOND mask."""
+    for group in sorted(g for g in Path(output_dir).iterdir() if g.is_dir()):
+        for mask_path in sorted(group.rglob("*_masks.tif")):
+            img_id = mask_path.stem.replace("_masks", "")
+            second_img_dir = Path(second_dir) / group.name / img_id
+            if not any(second_img_dir.glob("*_mask.h5")):
+                print(f"Skipping {img_id}: no SECOND mask in {second_img_dir}")
+                continue
+            out = Path(results_dir) / "per_image" / group.name / f"{img_id}.csv"
+            payload = {
+                "mask": str(mask_path),
+                "second_dir": str(second_img_dir),
+                "out": str(out),
+            }
+            payload.update(params)
+            yield f"{group.name}/{img_id}", payload
+
+
+def intensity_tasks(folder, channels, step, conv_fct):
+    """One task per ``_mask.h5`` with a TIFF for every channel, as in the GUI."""
+    from histograms import find_intensity_inputs
+
+    for image_id, mask_path, channel_files in find_intensity_inputs(folder, channels):
+        yield str(mask_path.parent.relative_to(folder)), {
+            "image_id": image_id,
+            "mask": str(mask_path),
+            "channels": channels,
+            "channel_files": [str(p) for p in channel_files],
+            "step": step,
+            "conv_fct": conv_fct,
+        }
+
+
+def collect_distance(results_dir):
+    """Combine per-image distance results into the group density/count/area CSVs."""
+    import pandas as pd
+
+    from distance import write_group_tables
+
+    results_dir = Path(results_dir)
+    per_image_dir = results_dir / "per_image"
+    for group_dir in sorted(p for p in per_image_dir.iterdir() if p.is_dir()):
+        tables = {"density": [], "count": [], "area": []}
+        for csv_path in sorted(group_dir.glob("*.csv")):
+            df = pd.read_csv(csv_path)
+            for name, rows in tables.items():
+                row = {"image_id": csv_path.stem}
+                row.update(zip(df["bin"], df[name]))
+                rows.append(row)
+        write_group_tables(
+            results_dir,
+            group_dir.name,
+            tables["density"],
+            tables["count"],
+            tables["area"],
+        )
+        print(f"{group_dir.name}: {len(tables['density'])} images")
+
+
+# Workers
+
+
+def work(
+    db_path,
+    stages=None,
+    lease=600,
+    max_tasks=None,
+    idle_exit=True,
+    poll=10,
+    resources=None,
+):
+    """Claim and run tasks until the queue is drained (or ``max_tasks`` are done).
+
+    An idle worker does not exit while failed tasks are waiting for a retry.
+    With a ``ResourceConfig`` the thread pools are capped at the stage's thread
+    count before each task, which also replaces a ``threads`` given at enqueue.
+    """
+    queue = WorkQueue(db_path)
+    worker = worker_id()
+    done = 0
+    t0 = time.time()
+
+    while max_tasks is None or done < max_tasks:
+        task = queue.claim(worker, stages=stages, lease=lease)
+        if task is None:
+            retry_at = queue.next_retry(stages)
+            if retry_at is None:
+                if idle_exit:
+                    break
+                time.sleep(poll)
+            else:
+                # failed tasks are waiting for their retry
+                time.sleep(min(max(retry_at - time.time(), 0), poll))
+            continue
+
+        if resources is not None:
+            threads = resources.stage_threads(task["stage"])
+            limit_threads(threads)
+            if "threads" in task["payload"]:
+                # the budget replaces the thread count given at enqueue
+                task["payload"]["threads"] = threads
+        keeper = _LeaseKeeper(queue, task["id"], worker, lease)
+        keeper.start()
+        try:
+            HANDLERS[task["stage"]](task["payload"])
+        except Exception:
+            queue.fail(task["id"], worker, traceback.format_exc())
+            print(f"{worker}: {task['stage']} {task['key']} failed")
+        else:
+            queue.complete(task["id"], worker, peak_rss_gb())
+            done += 1
+        finally:
+            keeper.stopped.set()
+            keeper.join()
+
+    elapsed = time.time() - t0
+    rate = done / elapsed * 60 if elapsed > 0 else 0
+    print(f"{worker}: {done} tasks in {elapsed:.1f} s ({rate:.1f}/min)")
+    return done
+
+
+def run_local(db_path, n_workers, **kwargs):
+    """Run several worker processes on this node and wait for them."""
+    procs = [
+        mp.Process(target=work, args=(db_path,), kwargs=kwargs)
+        for _ in range(n_workers)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+def run_stage(db_path, queue, stage, resources, **kwargs):
+    """Run workers for one stage, as many as fit the budget for its peak memory.
+
+    A stage without a recorded peak first runs a single task alone to measure it.
+    Each worker is a fresh process, so its peak covers one stage only.
+    """
+    threads = resources.stage_threads(stage)
+    peak = resources.peak_gb.get(stage, queue.peak_gb(stage))
+    if peak is None:
+        print(f"{stage}: measuring peak memory on one task")
+        probe = {**kwargs, "max_tasks": 1}
+        run_local(db_path, 1, stages=[stage], resources=resources, **probe)
+        peak = queue.peak_gb(stage)
+
+    n_workers = 1 if peak is None else resources.workers(stage, peak)
+    peak_text = "unknown" if peak is None else f"{peak:.2f} GB"
+    print(
+        f"{stage}: {n_workers} workers x {threads} threads "
+        f"(peak {peak_text} per worker)"
+    )
+    run_local(db_path, n_workers, stages=[stage], resources=resources, **kwargs)
+
+
+def run_scheduled(db_path, resources, stages=None, poll=10, idle_exit=True, **kwargs):
+    """Run the queued stages in order under the budget, each until it is complete.
+
+    A stage is run until none of its tasks are pending or running (waiting for
+    tasks that workers on other nodes hold).  Later stages are not started
+    while a stage has failed or unfinished tasks; returns False in that case.
+    Stage workers always exit when idle; without ``idle_exit`` the stages are
+    run again every ``poll`` seconds to pick up newly queued tasks.
+    """
+    queue = WorkQueue(db_path)
+    while True:
+        for stage in STAGES:
+            if stages and stage not in stages:
+                continue
+            while queue.remaining(stage):
+                run_stage(db_path, queue, stage, resources, **kwargs)
+                if kwargs.get("max_tasks") is not None:
+                    break
+                if queue.remaining(stage):
+                    time.sleep(poll)
+
+            failed, left = queue.failed(stage), queue.remaining(stage)
+            if failed or left:
+                print(
+                    f"{stage}: {failed} failed and {left} unfinished tasks, "
+                    "later stages not started (see status and retry)"
+                )
+                return False
+        if idle_exit or kwargs.get("max_tasks") is not None:
+            return True
+        time.sleep(poll)
+
+
+def print_status(queue, window=600):
+    counts, recent, failed = queue.status(window)
+    print("stage        status     tasks")
+    for r in counts:
+        print(f"{r['stage']:<12} {r['status']:<10} {r['n']}")
+
+    print(f"\nthroughput over the last {window / 60:.0f} min")
+    for r in recent:
+        rate = r["n"] / max(r["span_s"], 1e-6) * 60
+        peak = "" if r["peak_gb"] is None else f", peak {r['peak_gb']:.2f} GB"
+        print(
+            f"{r['stage']:<12} {r['worker']:<30} {rate:8.2f}/min "
+            f"(mean {r['mean_s']:.2f} s/task{peak})"
+        )
+
+    for r in failed:
+        print(f"\nFAILED {r['stage']} {r['key']}\n{r['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "db", type=Path, help="queue database on the shared filesystem"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = sub.add_parser("enqueue", help="add per-image tasks of one stage")
+    stage = enqueue.add_subparsers(dest="stage", required=True)
+
+    seg = stage.add_parser("segment")
+    seg.add_argument("--data", type=Path, default=Path("../data"))
+    seg.add_argument("--output", type=Path, default=Path("../output"))
+    seg.add_argument("--model", type=Path, required=True)
+    seg.add_argument("--gpu", action="store_true")
+    seg.add_argument("--precision", choices=["fp32", "bf16"], default="fp32")
+    seg.add_argument("--graph", default=None)
+    seg.add_argument(
+        "--threads", type=int, default=None, help="torch threads (unless budgeted)"
+    )
+    seg.add_argument(
+        "--inference-scale", type=float, default=1, help="downsample before eval"
+    )
+    seg.add_argument(
+        "--image-scale", type=float, default=0.5, help="PNG px per SECOND px"
+    )
+    seg.add_argument("--pixel-um", type=float, default=0.344, help="um per SECOND px")
+
+    ras = stage.add_parser("rasterize")
+    ras.add_argument("--second", type=Path, default=Path("../masks_SECOND"))
+
+    for name in ("distance", "analyze"):
+        dist = stage.add_parser(name)
+        dist.add_argument("--output", type=Path, default=Path("../output"))
+        dist.add_argument("--second", type=Path, default=Path("../masks_SECOND"))
+        dist.add_argument("--results", type=Path, default=Path("../results"))
+        dist.add_argument("--bin", type=int, default=50, help="bin width (um)")
+        dist.add_argument("--up-lim", type=int, default=1000, help="upper limit (um)")
+        # factors recorded in the mask take precedence, see objects.mask_factors
+        dist.add_argument("--conv", type=float, default=0.344, help="um per pixel")
+        dist.add_argument("--comp", type=float, default=0.5, help="compression factor")
+        if name == "distance":
+            dist.add_argument(
+                "--mode", choices=["raster", "geometry"], default="raster"
+            )
+        else:
+            dist.add_argument("--channels", default="", help="e.g. AF488,AF594")
+            dist.add_argument("--step", type=int, default=5, help="step size (um)")
+
+    inten = stage.add_parser("intensity")
+    inten.add_argument("--folder", type=Path, required=True)
+    inten.add_argument("--channels", required=True, help="e.g. AF488,AF594")
+    inten.add_argument("--step", type=int, default=5, help="step size (um)")
+    inten.add_argument("--conv", type=float, required=True, help="um per pixel")
+
+    for name in ("work", "run"):
+        p = sub.add_parser(name, help="run worker(s) until the queue is drained")
+        p.add_argument("--stage", action="append", help="only run these stages")
+        p.add_argument("--lease", type=float, default=600, help="lease length (s)")
+        p.add_argument("--max-tasks", type=int, default=None)
+        p.add_argument("--wait", action="store_true", help="keep polling when idle")
+        p.add_argument("--resources", type=Path, help="JSON budget (resources.py)")
+        p.add_argument("--cpus", type=int, help="cores to use (default: all)")
+        p.add_argument("--memory-gb", type=float, help="memory budget in GB")
+        if name == "run":
+            p.add_argument(
+                "--workers", type=int, help="fixed worker count instead of the budget"
+            )
+
+    st = sub.add_parser("status")
+    st.add_argument("--window", type=float, default=600, help="throughput window (s)")
+
+    rt = sub.add_parser("retry", help="requeue failed tasks")
+    rt.add_argument("--stage", default=None)
+
+    col = sub.add_parser("collect", help="combine per-image distance results")
+    col.add_argument("--results", type=Path, default=Path("../results"))
+
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        queue = WorkQueue(args.db)
+        if args.stage == "segment":
+            tasks = segment_tasks(
+                args.data,
+                args.output,
+                args.model,
+                args.gpu,
+                args.precision,
+                args.graph,
+                args.threads,
+                args.inference_scale,
+                args.image_scale,
+                args.pixel_um,
+            )
+        elif args.stage == "rasterize":
+            tasks = rasterize_tasks(args.second)
+        elif args.stage in ("distance", "analyze"):
+            params = {
+                "bin": args.bin,
+                "up_lim": args.up_lim,
+                "conv_fct": args.conv,
+                "comp_fct": args.comp,
+            }
+            if args.stage == "distance":
+                params["mode"] = args.mode
+            else:
+                params["channels"] = [
+                    ch for ch in args.channels.replace(" ", "").split(",") if ch
+                ]
+                params["step"] = args.step
+            tasks = distance_tasks(args.output, args.second, args.results, params)
+        else:
+            channels = [ch for ch in args.channels.replace(" ", "").split(",") if ch]
+            tasks = intensity_tasks(args.folder, channels, args.step, args.conv)
+
+        added = sum(queue.add(args.stage, key, payload) for key, payload in tasks)
+        print(f"{added} {args.stage} tasks added")
+
+    elif args.command in ("work", "run"):
+        resources = ResourceConfig.load(
+            args.resources, cpus=args.cpus, memory_gb=args.memory_gb
+        )
+        kwargs = dict(
+            stages=args.stage,
+            lease=args.lease,
+            max_tasks=args.max_tasks,
+            idle_exit=not args.wait,
+        )
+        if args.command == "work":
+            # a lone worker per node keeps the library defaults unless budgeted
+            budgeted = args.resources or args.cpus or args.memory_gb
+            work(args.db, resources=resources if budgeted else None, **kwargs)
+        elif args.workers:
+            run_local(args.db, args.workers, resources=resources, **kwargs)
+        else:
+            print(resources)
+            run_scheduled(args.db, resources, **kwargs)
+        print_status(WorkQueue(args.db))
+
+    elif args.command == "status":
+        print_status(WorkQueue(args.db), args.window)
+
+    elif args.command == "retry":
+        print(f"{WorkQueue(args.db).retry_failed(args.stage)} tasks requeued")
+
+    elif args.command == "collect":
+        collect_distance(args.results)
+
+
+if __name__ == "__main__":
+    main()